@@ -13,12 +13,117 @@ You should have received a copy of the GNU General Public License
 along with szokoly.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import gzip
 import os
 import re
 import time
 from binascii import unhexlify
 from datetime import datetime, timedelta
 from glob import glob
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+BUNDLE_SUFFIX = '.ecs.gz'
+INDEX_SUFFIX = '.ecs.idx'
+
+
+class ECSBundle(object):
+    """
+    Hourly bundle of ecs log files as written by backup_ecs.py with BUNDLE=1.
+    Each log file is a gzip member of its own which is located by the index
+    file next to the bundle. A member is named as if the bundle was a folder,
+    for example /var/web/2017-0427-04.ecs.gz/2017-0427-040405.log
+
+    Usage example:
+
+    bundle = ECSBundle('/var/web/2017-0427-04.ecs.gz')
+    for name in bundle.members('20170427:041000', '20170427:042000'):
+        for line in open_ecs(name):
+            print line,
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = []
+        self.index = {}
+        fd = open(path[:-len(BUNDLE_SUFFIX)] + INDEX_SUFFIX)
+        try:
+            for line in fd:
+                fields = line.split()
+                if len(fields) == 5:
+                    entry = (fields[0], int(fields[1]), int(fields[2]),
+                             fields[3], fields[4])
+                    self.entries.append(entry)
+                    self.index[entry[0]] = entry
+        finally:
+            fd.close()
+
+    def members(self, start=None, end=None):
+        """
+        Returns the names of the log files in the bundle with lines between
+        the start and end timestamps.
+        :param start: string of YYYYMMDD:hhmmss timestamp or None
+        :param end: string of YYYYMMDD:hhmmss timestamp or None
+        :return: list of member names
+        """
+        names = []
+        for filename, offset, length, first, last in self.entries:
+            if start is not None and last != '-' and last[:15] < start:
+                continue
+            if end is not None and first != '-' and first[:15] > end:
+                continue
+            names.append(os.path.join(self.path, filename))
+        return names
+
+    def open(self, filename):
+        """
+        Returns a file object of the decompressed log file of the bundle.
+        :param filename: string of the log file name
+        :return: file object
+        """
+        filename, offset, length, first, last = self.index[filename]
+        fd = open(self.path, 'rb')
+        try:
+            fd.seek(offset)
+            data = fd.read(length)
+        finally:
+            fd.close()
+        return gzip.GzipFile(filename, 'rb', fileobj=StringIO(data))
+
+
+def is_bundle(path):
+    return path.endswith(BUNDLE_SUFFIX)
+
+
+def open_ecs(name):
+    """
+    Opens an ecs log file or a log file of a bundle for reading.
+    :param name: string of file or bundle member name
+    :return: file object
+    """
+    bundle = os.path.dirname(name)
+    if is_bundle(bundle) and os.path.isfile(bundle):
+        return ECSBundle(bundle).open(os.path.basename(name))
+    return open(name)
+
+
+def expand_bundles(logfiles, start=None, end=None):
+    """
+    Replaces the bundles in logfiles with the names of their members which
+    have lines between start and end, the index files are dropped.
+    :param logfiles: list of log file and bundle names
+    :return: list of log file and bundle member names
+    """
+    names = []
+    for logfile in logfiles:
+        if logfile.endswith(INDEX_SUFFIX):
+            continue
+        if is_bundle(logfile):
+            names.extend(ECSBundle(logfile).members(start, end))
+        else:
+            names.append(logfile)
+    return names
 
 
 class SIPReader(object):
@@ -30,8 +135,10 @@ class SIPReader(object):
     'srcip', 'srcport': string of source IP address and int of srcport
     'dstip', 'dstport': string of destination IP address and int of dstport
     'sipmsg': string of SIP message
+    The logfiles may be bundles written by backup_ecs.py or members of them,
+    the optional timeframe as of ECSLogs selects the log files to read.
     """
-    def __init__(self, logfiles=[], logdir='/var/log/ecs'):
+    def __init__(self, logfiles=[], logdir='/var/log/ecs', timeframe=None):
         self.logdir = logdir
         self.logfiles = logfiles
         self.follow = True
@@ -45,12 +152,17 @@ class SIPReader(object):
         self.ecs = ''
         if self.logfiles:
             self.follow = False
+            if timeframe is not None:
+                self.logfiles = list(ECSLogs(logfiles=self.logfiles,
+                                             timeframe=timeframe))
+            else:
+                self.logfiles = expand_bundles(self.logfiles)
             self.total = len(self.logfiles)
             try:
                 self.ecs = self.logfiles.pop(0)
             except IndexError:
                 raise StopIteration
-            self.fd = open(self.ecs)
+            self.fd = open_ecs(self.ecs)
         else:
             self.getlog = self.iterecs(logdir=self.logdir)
             self.ecs = self.getlog.next()
@@ -106,7 +218,7 @@ class SIPReader(object):
                         self.ecs = self.logfiles.pop(0)
                     except IndexError:
                         raise StopIteration
-                    self.fd = open(self.ecs)
+                    self.fd = open_ecs(self.ecs)
                     break
                 newecs = self.getlog.next()
                 if newecs != self.ecs:
@@ -199,7 +311,9 @@ class ECSLogs(object):
     Infinite stateful generator class which returns the ecs log files
     in sequential order created from the initialization of the class
     or returns the last ecs log file if no new one has been created since
-    the last yield.
+    the last yield. Bundles written by backup_ecs.py in logdir or logfiles
+    are replaced by the members of them within the timeframe, which are to
+    be opened with open_ecs().
     """
     T = '(\d{4})(\d{0,2})?(\d{0,2})?:?(\d{0,2})?(\d{0,2})?(\d{0,2})?'
     LOGDIR = '/var/log/ecs/'
@@ -212,16 +326,21 @@ class ECSLogs(object):
         if timeframe is not None:
             if self.logfiles is None:
                 self.logfiles = glob(os.path.join(self.logdir, '20*'))
+            logfiles = [x for x in self.logfiles if not is_bundle(x) and
+                        not x.endswith(INDEX_SUFFIX)]
+            bundles = [x for x in self.logfiles if is_bundle(x)]
             start, sep, end = timeframe.partition('-')
             m = self.reTimeframe.search(start)
             start = datetime(*(int(x) for x in m.groups() if x))
+            start_ts = time.strftime("%Y%m%d:%H%M%S", start.timetuple())
             start = time.strftime("%Y-%m%d-%H%M%S.log", start.timetuple())
-            first_index = len(self.logfiles)
-            last_index = len(self.logfiles)
+            end_ts = None
+            first_index = len(logfiles)
+            last_index = len(logfiles)
             try:
-                first = next(x for x in self.logfiles if
+                first = next(x for x in logfiles if
                              os.path.basename(x) >= start)
-                first_index = self.logfiles.index(first)
+                first_index = logfiles.index(first)
                 if first_index > 0:
                     first_index -= 1
             except StopIteration:
@@ -229,16 +348,20 @@ class ECSLogs(object):
             if end:
                 m = self.reTimeframe.search(end)
                 end = datetime(*(int(x) for x in m.groups() if x))
+                end_ts = time.strftime("%Y%m%d:%H%M%S", end.timetuple())
                 end = time.strftime("%Y-%m%d-%H%M%S.log", end.timetuple())
                 try:
-                    last = next(x for x in self.logfiles if
+                    last = next(x for x in logfiles if
                                 os.path.basename(x) > end)
-                    last_index = self.logfiles.index(last)
+                    last_index = logfiles.index(last)
                 except StopIteration:
                     pass
-            self.logs = self.logfiles[first_index:last_index]
+            self.logs = logfiles[first_index:last_index]
+            if bundles:
+                self.logs.extend(expand_bundles(bundles, start_ts, end_ts))
+                self.logs.sort(key=os.path.basename)
         elif logfiles:
-            self.logs = self.logfiles
+            self.logs = expand_bundles(self.logfiles)
         else:
             self.old = glob(os.path.join(self.logdir, '20*'))
             self.logs = self.old[-1:]
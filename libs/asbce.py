@@ -6,17 +6,35 @@ import gzip
 import os
 import re
 import shlex
+import sys
+import tempfile
+import threading
 import time
+from array import array
+from ast import literal_eval
 from collections import namedtuple
 from datetime import datetime
 from glob import glob
-from itertools import chain
+from itertools import chain, compress, count, repeat
+from operator import sub
 from netifaces import interfaces, ifaddresses, AF_INET
 from platform import node
-from subprocess import Popen, PIPE
+from stat import S_ISREG, S_IWGRP, S_IWOTH
+from subprocess import Popen, PIPE, STDOUT
 from textwrap import wrap
+try:
+    intern
+except NameError:
+    from sys import intern
 
 Server = namedtuple("Server", ["name", "type"])
+SigIface = namedtuple("signaling_iface", ["name", "public_ip"])
+MedIface = namedtuple("media_iface", ["name", "iface", "public_ip"])
+FlowRate = namedtuple("FlowRate", ["Rx", "Snt", "Drp"])
+FLOW_IFACES = {"0": "A1", "1": "A2", "2": "B1", "3": "B2"}
+FLOW_TAIL = ["Enc", "Dec", "Snt", "Drp", "Rx", "Rly", "ECH"]
+FLOW_ANCHORS = ["->", "OUT", "RELAY", "->", "in", "VLAN", "out", "VLAN"]
+FLOW_HEX = (16,) * 9
 
 def memoize(func):
     """A decorator to cache the return value of func.
@@ -84,6 +102,62 @@ class Flow(object):
         )
 
 
+def split_flow(line):
+    """Splits a showflow line by the positions of its tokens, which are
+    expected to be laid out as:
+
+    <InIf> [<InSrc> -> <InDst>] OUT <OutIf> RELAY <OutSrc> -> <OutDst> ...
+    in VLAN <x> out VLAN <y> Enc <x> Dec <x> Snt <x> Drp <x> Rx <x> Rly <x>
+    ECH <x>
+
+    Args:
+        line (str): flow line from list returned by showflow
+
+    Returns:
+        list: values of the Flow fields in order or None if the line is
+            laid out otherwise
+    """
+    head, sep, tail = line.partition(" [")
+    t = tail.split()
+    if (not sep or len(t) < 29 or t[-14::2] != FLOW_TAIL or
+            [t[1], t[3], t[5], t[7], t[-20], t[-19], t[-17], t[-16]] !=
+            FLOW_ANCHORS or t[2][-1:] != "]"):
+        return None
+    inif = head[head.rfind(" ") + 1:]
+    insrcip, _, insrcport = t[0].rpartition(":")
+    indstip, _, indstport = t[2][:-1].rpartition(":")
+    outsrcip, _, outsrcport = t[6].rpartition(":")
+    outdstip, _, outdstport = t[8].rpartition(":")
+    digits = inif + t[4] + insrcport + indstport + outsrcport + outdstport
+    ips = insrcip + indstip + outsrcip + outdstip
+    if not (inif and digits.isdigit() and ips.replace(".", "").isdigit()):
+        return None
+    try:
+        values = [FLOW_IFACES.get(inif, "?"), insrcip, int(insrcport),
+                  indstip, int(indstport), FLOW_IFACES.get(t[4], "?"),
+                  outsrcip, int(outsrcport), outdstip, int(outdstport)]
+        values.extend(map(int, t[-18:-14:3] + t[-13::2], FLOW_HEX))
+    except ValueError:
+        return None
+    return values
+
+
+def parse_flow(line, flowclass=Flow):
+    """Parses a showflow line with split_flow.
+
+    Args:
+        line (str): flow line from list returned by showflow
+        flowclass (class, optional): class to instantiate with the values
+
+    Returns:
+        Flow: Flow class instance or None if the line is laid out otherwise
+    """
+    values = split_flow(line)
+    if values is None:
+        return None
+    return flowclass(*values)
+
+
 class Msg(object):
     """Data structure to store trace log message info."""
     __slots__ = ["srcip", "srcport", "dstip", "dstport", "timestamp",
@@ -504,12 +578,131 @@ class TracesbcSIPReader(object):
             return open(filename)
 
 
+class SQLSession(object):
+    """Long-lived SQL client coprocess, fed with statements on its stdin.
+
+    Each statement of a batch is followed by a SELECT of a unique marker
+    string, so that the output of the statements can be told apart on the
+    stdout of the client. A whole batch is written in one go, which makes
+    several queries cost a single round trip instead of a fork/exec each.
+    The batches of concurrent threads are run one after the other.
+    """
+    reError = re.compile(r"^(?:\S+:\S+ )?(?:ERROR|FATAL):", re.M)
+
+    def __init__(self, cmd):
+        """Initializes SQLSession instance, the client is started by the
+        first execute.
+
+        Args:
+            cmd (str): SQL client command reading statements from stdin
+
+        Returns:
+            obj: SQLSession instance
+        """
+        self.cmd = cmd
+        self.proc = None
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    def execute(self, sqlcmds):
+        """Runs the statements in one batch.
+
+        Args:
+            sqlcmds (iterable): SQL command strings
+
+        Returns:
+            list: stripped output of the statements in the same order
+
+        Raises:
+            RuntimeError: if the client fails to run a statement or exits
+        """
+        with self.lock:
+            return self._execute(sqlcmds)
+
+    def _execute(self, sqlcmds):
+        """Runs the statements in one batch, see execute."""
+        if self.proc is None or self.proc.poll() is not None:
+            self.proc = Popen(shlex.split(self.cmd), shell=False, stdin=PIPE,
+                              stdout=PIPE, stderr=STDOUT,
+                              universal_newlines=True)
+        script, markers = [], []
+        for sqlcmd in sqlcmds:
+            self.seq += 1
+            marker = "ASBCE-{0}-{1}".format(os.getpid(), self.seq)
+            script.append("{0};\nSELECT '{1}';\n".format(
+                          sqlcmd.strip().rstrip(";"), marker))
+            markers.append(marker)
+        try:
+            self.proc.stdin.write("".join(script))
+            self.proc.stdin.flush()
+        except (IOError, OSError):
+            self.close()
+            raise RuntimeError("SQL client is not running: " + self.cmd)
+        outputs, errors = [], []
+        for marker in markers:
+            lines = []
+            for line in iter(self.proc.stdout.readline, ""):
+                if line.strip() == marker:
+                    break
+                lines.append(line)
+            else:
+                self.close()
+                raise RuntimeError("".join(lines).strip() or
+                                   "SQL client exited")
+            output = "".join(lines).strip()
+            if self.reError.search(output):
+                errors.append(output)
+            outputs.append(output)
+        if errors:
+            raise RuntimeError("\n".join(errors))
+        return outputs
+
+    def close(self):
+        """Closes the stdin of the client and waits for it to exit."""
+        if self.proc is not None:
+            try:
+                self.proc.stdin.close()
+            except (IOError, OSError):
+                pass
+            self.proc.wait()
+            self.proc = None
+
+
 class ASBCE(object):
     """Simple ASBCE obejct to enable turning ON and OFF debug logging
     for SIPCC subprocess for SSYNDI and obtain basic configuration info.
     """
     SYSINFO_PATH = "/usr/local/ipcs/etc/sysinfo"
     LOGLEVEL_ERR = "Incorrect LOGLEVEL value: {0}"
+    PSQL_CMD = "psql -t -U postgres sbcedb"
+    TOPOLOGY_CACHE = "/var/run/asbce_topology"
+    TOPOLOGY_MARKERS = (SYSINFO_PATH,)
+    TOPOLOGY_MAXAGE = 86400
+    TOPOLOGY = {"ems_ip": None, "signaling_ifaces": SigIface,
+                "media_ifaces": MedIface, "servers": Server, "publics": None,
+                "ifaces": None, "mgmt_ip": None, "version": None,
+                "hardware": None}
+    SQL_SIGNALING_IFACES = "SELECT SIGNAL_NAME, IP_ADDRESS, PUBLIC_IP\
+                            FROM SIP_SIGNALING_INTERFACE_VIEW"
+    SQL_MEDIA_IFACES = "SELECT MEDIA_NAME, INTERFACE, IP_ADDRESS, PUBLIC_IP\
+                        FROM SIP_MEDIA_INTERFACE_VIEW"
+    SQL_SERVERS = "SELECT DISTINCT SERVER_CONFIG_NAME, SERVER_TYPE, SERVER_ADDRESS\
+                   FROM SIP_SERVER_CONFIG, SIP_SERVER_CONFIG_ADDRESSES\
+                   WHERE SIP_SERVER_CONFIG_ADDRESSES.SERVER_CONFIG_ID =\
+                         SIP_SERVER_CONFIG.SERVER_CONFIG_ID"
+    SQL_SIPCC_LOGLEVEL = "SELECT LOGLEVEL FROM EXECUTION_LOGLEVEL\
+                          WHERE SUBSYSTEM='LOG_SUB_SIPCC'"
+    SQL_SIGNATURES = (
+        ("signaling_ifaces",
+         "SELECT COUNT(*), MIN(IP_ADDRESS), MAX(IP_ADDRESS), MAX(PUBLIC_IP)\
+          FROM SIP_SIGNALING_INTERFACE_VIEW"),
+        ("media_ifaces",
+         "SELECT COUNT(*), MIN(IP_ADDRESS), MAX(IP_ADDRESS), MAX(PUBLIC_IP)\
+          FROM SIP_MEDIA_INTERFACE_VIEW"),
+        ("servers",
+         "SELECT COUNT(*), MAX(SERVER_CONFIG_ID), MIN(SERVER_ADDRESS),\
+                 MAX(SERVER_ADDRESS) FROM SIP_SERVER_CONFIG_ADDRESSES"),
+    )
     RE_FLOW = (
         r"(?P<InIf>\d+) \[",
         r"(?P<InSrcIP>[\d+.]*):",
@@ -532,11 +725,13 @@ class ASBCE(object):
         r"(?P<Ech>\w+)",
     )
 
-    def __init__(self, mock=False):
+    def __init__(self, mock=False, cache=True):
         """Initializes Aasbce instance.
 
         Args:
             mock (bool): if the instance should not make changes in the DB.
+            cache (bool): if the topology should be loaded from and saved
+                to the TOPOLOGY_CACHE snapshot.
         Returns:
             obj: Asbce instance
         """
@@ -553,11 +748,23 @@ class ASBCE(object):
         self._version = None
         self._hostname = node()
         self._hardware = None
+        self._sipcc_loglevel = None
+        self._sql = None
         self.lastflows = {}
         self.lastflows_timestamp = None
+        self.cache = cache
+        self.topology_signatures = None
+        if not cache or not self.load_topology():
+            self.prefetch()
+            if cache:
+                try:
+                    self.save_topology()
+                except Exception:
+                    pass
         self.sipcc_loglevel_inital = self.sipcc_loglevel
         self.Flow = Flow
         self.reFlow = re.compile("".join(self.RE_FLOW), re.I)
+        self.collector = FlowCollector(self)
 
     @property
     def ems_ip(self):
@@ -579,20 +786,14 @@ class ASBCE(object):
         and IPv6 addresses as well.
         """
         if self._ifaces is None:
-            self._ifaces = {
-                ifaddr["addr"]:iface for iface in interfaces() for ifaddrs in
-                ifaddresses(iface).values() for ifaddr in ifaddrs
-            }
-            self._ifaces.update({k: self._ifaces[self.publics[k]] for k in
-                        set(self.publics).difference(set(self.ifaces))})
+            self._ifaces = self._build_ifaces(self.publics)
         return self._ifaces
 
     @property
     def mgmt_ip(self):
         """str: Returns the IP address of the SBCE's M1 interface."""
         if self._mgmt_ip is None:
-            reverse_ifaces = dict((v, k) for k, v in self.ifaces.items())
-            self._mgmt_ip = reverse_ifaces.get("M1", "")
+            self._mgmt_ip = self._build_mgmt_ip(self.ifaces)
         return self._mgmt_ip
 
     @property
@@ -602,16 +803,8 @@ class ASBCE(object):
         signaling interface name and public IP address of it as values.
         """
         if self._signaling_ifaces is None:
-            self._signaling_ifaces = {}
-            SigIface = namedtuple('signaling_iface', ["name", "public_ip"])
-            sqlcmd = "SELECT SIGNAL_NAME, IP_ADDRESS, PUBLIC_IP\
-                      FROM SIP_SIGNALING_INTERFACE_VIEW"
-            signaling_ifaces = self._exec_sql(sqlcmd)
-            if signaling_ifaces:
-                for signaling_iface in signaling_ifaces.split("\n"):
-                    l = signaling_iface.replace("|", "").split()
-                    name, ip, public_ip = " ".join(l[0:-2]), l[-2], l[-1]
-                    self._signaling_ifaces.update({ip: SigIface(name, public_ip)})
+            self._signaling_ifaces = self._parse_signaling_ifaces(
+                self._exec_sql(self.SQL_SIGNALING_IFACES))
         return self._signaling_ifaces
 
     @property
@@ -621,16 +814,8 @@ class ASBCE(object):
         media interface name, ethernet interface name and public IP address.
         """
         if self._media_ifaces is None:
-            self._media_ifaces = {}
-            MedIface = namedtuple("media_iface", ["name", "iface", "public_ip"])
-            sqlcmd = "SELECT MEDIA_NAME, INTERFACE, IP_ADDRESS, PUBLIC_IP\
-                      FROM SIP_MEDIA_INTERFACE_VIEW"
-            media_ifaces = self._exec_sql(sqlcmd)
-            if media_ifaces:
-                for media_iface in media_ifaces.split("\n"):
-                    l = media_iface.replace("|", "").split()
-                    name, iface, ip, public_ip = " ".join(l[0:-3]), l[-3], l[-2], l[-1]
-                    self._media_ifaces.update({ip: MedIface(name, iface, public_ip)})
+            self._media_ifaces = self._parse_media_ifaces(
+                self._exec_sql(self.SQL_MEDIA_IFACES))
         return self._media_ifaces
 
     @property
@@ -640,23 +825,264 @@ class ASBCE(object):
         server name and its type as values.
         """
         if self._servers is None:
-            self._servers = {}
-            sqlcmd = "SELECT DISTINCT SERVER_CONFIG_NAME, SERVER_TYPE, SERVER_ADDRESS\
-                      FROM SIP_SERVER_CONFIG, SIP_SERVER_CONFIG_ADDRESSES\
-                      WHERE SIP_SERVER_CONFIG_ADDRESSES.SERVER_CONFIG_ID =\
-                            SIP_SERVER_CONFIG.SERVER_CONFIG_ID"
-            servers = self._exec_sql(sqlcmd)
-            if servers:
-                for server in servers.split("\n"):
-                    l = server.replace("|", "").split()
-                    name, type, ip = " ".join(l[0:-2]), l[-2], l[-1]
-                    if type == "CALL_SERVER":
-                        type = "Call"
-                    else:
-                        type = "Trk"
-                    self._servers.update({ip: Server(name, type)})
+            self._servers = self._parse_servers(
+                self._exec_sql(self.SQL_SERVERS))
         return self._servers
 
+    def prefetch(self):
+        """Queries the interfaces, SIP servers, the signatures of their
+        tables and the 'LOG_SUB_SIPCC' loglevel in one batch and caches
+        them, the properties derived from these are recalculated at their
+        next use.
+
+        Returns:
+            None
+        """
+        names = [name for name, _ in self.SQL_SIGNATURES]
+        outputs = self._exec_sqls([self.SQL_SIGNALING_IFACES,
+                                   self.SQL_MEDIA_IFACES,
+                                   self.SQL_SERVERS,
+                                   self.SQL_SIPCC_LOGLEVEL] +
+                                  [sql for _, sql in self.SQL_SIGNATURES])
+        self.topology_signatures = dict(zip(names, outputs[4:]))
+        self._signaling_ifaces = self._parse_signaling_ifaces(outputs[0])
+        self._media_ifaces = self._parse_media_ifaces(outputs[1])
+        self._servers = self._parse_servers(outputs[2])
+        self._sipcc_loglevel = self._parse_sipcc_loglevel(outputs[3])
+        self._publics = None
+        self._ifaces = None
+        self._mgmt_ip = None
+
+    def load_topology(self):
+        """Loads the topology properties from the TOPOLOGY_CACHE snapshot
+        if it was saved on this host and is still up to date. It is out of
+        date if the SQL_SIGNATURES of the config tables, queried in one
+        batch with the 'LOG_SUB_SIPCC' loglevel, or the mtime and size of
+        the TOPOLOGY_MARKERS files have changed since it was saved, or it is
+        older than TOPOLOGY_MAXAGE seconds. The snapshot is not used unless
+        it is a regular file owned by the effective user and writable only
+        by it.
+
+        Returns:
+            bool: True if the snapshot was loaded, False otherwise
+        """
+        try:
+            fd = os.open(self.TOPOLOGY_CACHE,
+                         os.O_RDONLY | getattr(os, "O_NOFOLLOW", 0))
+        except OSError:
+            return False
+        with os.fdopen(fd, "r") as handle:
+            st = os.fstat(fd)
+            if (not S_ISREG(st.st_mode) or st.st_uid != os.geteuid() or
+                    st.st_mode & (S_IWGRP | S_IWOTH)):
+                return False
+            try:
+                snapshot = literal_eval(handle.read())
+                if (snapshot["hostname"] != self.hostname or
+                        snapshot["markers"] != self._topology_markers() or
+                        time.time() - snapshot["timestamp"] >
+                        self.TOPOLOGY_MAXAGE):
+                    return False
+                values = {}
+                for name, tupleclass in self.TOPOLOGY.items():
+                    value = snapshot[name]
+                    if tupleclass is not None:
+                        value = dict((k, tupleclass(*v))
+                                     for k, v in value.items())
+                    values[name] = value
+            except Exception:
+                return False
+        names = [name for name, _ in self.SQL_SIGNATURES]
+        outputs = self._exec_sqls([sql for _, sql in self.SQL_SIGNATURES] +
+                                  [self.SQL_SIPCC_LOGLEVEL])
+        self._sipcc_loglevel = self._parse_sipcc_loglevel(outputs[-1])
+        signatures = dict(zip(names, outputs))
+        if snapshot.get("signatures") != signatures:
+            return False
+        for name, value in values.items():
+            setattr(self, "_" + name, value)
+        self.topology_signatures = signatures
+        return True
+
+    def save_topology(self):
+        """Saves the topology properties to the TOPOLOGY_CACHE snapshot,
+        replacing it atomically with a temporary file of the same directory.
+        The snapshot holds literals only, it is read with literal_eval.
+
+        Returns:
+            None
+        """
+        snapshot = {"hostname": self.hostname, "timestamp": time.time(),
+                    "markers": self._topology_markers(),
+                    "signatures": self.topology_signatures}
+        for name, tupleclass in self.TOPOLOGY.items():
+            value = getattr(self, name)
+            if tupleclass is not None:
+                value = dict((k, tuple(v)) for k, v in value.items())
+            snapshot[name] = value
+        fd, tmpfile = tempfile.mkstemp(
+            dir=os.path.dirname(self.TOPOLOGY_CACHE),
+            prefix="." + os.path.basename(self.TOPOLOGY_CACHE))
+        try:
+            with os.fdopen(fd, "w") as handle:
+                handle.write(repr(snapshot))
+            os.rename(tmpfile, self.TOPOLOGY_CACHE)
+        except Exception:
+            os.remove(tmpfile)
+            raise
+
+    def refresh_topology(self):
+        """Queries the topology again and saves the snapshot.
+
+        Returns:
+            None
+        """
+        self._ems_ip = None
+        self._sysinfo = None
+        self._version = None
+        self._hardware = None
+        self.prefetch()
+        self.save_topology()
+
+    @classmethod
+    def _topology_markers(cls):
+        """Returns the mtime and size of the TOPOLOGY_MARKERS files.
+
+        Returns:
+            list: (path, mtime, size) tuples, mtime and size of missing
+                files are None
+        """
+        markers = []
+        for path in cls.TOPOLOGY_MARKERS:
+            try:
+                stat = os.stat(path)
+                markers.append((path, stat.st_mtime, stat.st_size))
+            except OSError:
+                markers.append((path, None, None))
+        return markers
+
+    @staticmethod
+    def _build_publics(signaling_ifaces, media_ifaces):
+        """Builds the public/private interface map.
+
+        Args:
+            signaling_ifaces (dict): see signaling_ifaces
+            media_ifaces (dict): see media_ifaces
+
+        Returns:
+            dict: see publics
+        """
+        c = chain(signaling_ifaces.items(), media_ifaces.items())
+        return dict((v.public_ip, k) for k, v in c)
+
+    @staticmethod
+    def _build_ifaces(publics):
+        """Builds the interface map from the addresses of the host and
+        the public/private interface map.
+
+        Args:
+            publics (dict): see publics
+
+        Returns:
+            dict: see ifaces
+        """
+        ifaces = {
+            ifaddr["addr"]:iface for iface in interfaces() for ifaddrs in
+            ifaddresses(iface).values() for ifaddr in ifaddrs
+        }
+        ifaces.update({k: ifaces[publics[k]] for k in
+                       set(publics).difference(set(ifaces))})
+        return ifaces
+
+    @staticmethod
+    def _build_mgmt_ip(ifaces):
+        """Returns the IP address of the M1 interface.
+
+        Args:
+            ifaces (dict): see ifaces
+
+        Returns:
+            str: IP address, empty if there is no M1 interface
+        """
+        reverse_ifaces = dict((v, k) for k, v in ifaces.items())
+        return reverse_ifaces.get("M1", "")
+
+    @staticmethod
+    def _parse_signaling_ifaces(output):
+        """Converts the output of SQL_SIGNALING_IFACES to dict.
+
+        Args:
+            output (str): SQL client output
+
+        Returns:
+            dict: see signaling_ifaces
+        """
+        signaling_ifaces = {}
+        if output:
+            for signaling_iface in output.split("\n"):
+                l = signaling_iface.replace("|", "").split()
+                name, ip, public_ip = " ".join(l[0:-2]), l[-2], l[-1]
+                signaling_ifaces.update({ip: SigIface(name, public_ip)})
+        return signaling_ifaces
+
+    @staticmethod
+    def _parse_media_ifaces(output):
+        """Converts the output of SQL_MEDIA_IFACES to dict.
+
+        Args:
+            output (str): SQL client output
+
+        Returns:
+            dict: see media_ifaces
+        """
+        media_ifaces = {}
+        if output:
+            for media_iface in output.split("\n"):
+                l = media_iface.replace("|", "").split()
+                name, iface, ip, public_ip = " ".join(l[0:-3]), l[-3], l[-2], l[-1]
+                media_ifaces.update({ip: MedIface(name, iface, public_ip)})
+        return media_ifaces
+
+    @staticmethod
+    def _parse_servers(output):
+        """Converts the output of SQL_SERVERS to dict.
+
+        Args:
+            output (str): SQL client output
+
+        Returns:
+            dict: see servers
+        """
+        servers = {}
+        if output:
+            for server in output.split("\n"):
+                l = server.replace("|", "").split()
+                name, type, ip = " ".join(l[0:-2]), l[-2], l[-1]
+                if type == "CALL_SERVER":
+                    type = "Call"
+                else:
+                    type = "Trk"
+                servers.update({ip: Server(name, type)})
+        return servers
+
+    @staticmethod
+    def _parse_sipcc_loglevel(output):
+        """Validates the output of SQL_SIPCC_LOGLEVEL.
+
+        Args:
+            output (str): SQL client output
+
+        Returns:
+            str: loglevel
+
+        Raises:
+            RuntimeError: if the returned value is something unexpected
+                          so as to stop corrupting the DB further
+        """
+        if not re.match("[01]{6}$", output):
+            raise RuntimeError(output)
+        return output
+
     @property
     def sysinfo(self):
         """str: Returns the content of the sysinfo file."""
@@ -680,8 +1106,8 @@ class ASBCE(object):
     def publics(self):
         """dict: Returns the public/private interface map."""
         if self._publics is None:
-            c = chain(self.signaling_ifaces.items(), self.media_ifaces.items())
-            self._publics = dict((v.public_ip, k) for k, v in c)
+            self._publics = self._build_publics(self.signaling_ifaces,
+                                                self.media_ifaces)
         return self._publics
 
     @property
@@ -702,18 +1128,18 @@ class ASBCE(object):
 
     @property
     def sipcc_loglevel(self):
-        """str: Returns the value of 'LOG_SUB_SIPCC' for SSYNDI.
+        """str: Returns the value of 'LOG_SUB_SIPCC' for SSYNDI. The value
+        is cached, it is read back from the DB by prefetch and by the setter
+        together with the UPDATE.
 
         Raises:
             RuntimeError: if the returned value is something unexpected
                           so as to stop corrupting the DB further
         """
-        sqlcmd = "SELECT LOGLEVEL FROM EXECUTION_LOGLEVEL\
-                  WHERE SUBSYSTEM='LOG_SUB_SIPCC'"
-        value = self._exec_sql(sqlcmd)
-        if not re.match("[01]{6}$", value):
-            raise RuntimeError(value)
-        return value
+        if self._sipcc_loglevel is None:
+            self._sipcc_loglevel = self._parse_sipcc_loglevel(
+                self._exec_sql(self.SQL_SIPCC_LOGLEVEL))
+        return self._sipcc_loglevel
 
     @sipcc_loglevel.setter
     def sipcc_loglevel(self, value):
@@ -730,12 +1156,15 @@ class ASBCE(object):
                 differ from the current sipcc_loglevel value in position 3
                 that is at index 2
         """
-        pattern = "".join((self.sipcc_loglevel[:2], "[01]", self.sipcc_loglevel[3:]))
+        current = self.sipcc_loglevel
+        pattern = "".join((current[:2], "[01]", current[3:]))
         if not re.match(pattern, value):
             raise ValueError(self.LOGLEVEL_ERR.format(value))
         sqlcmd = "UPDATE EXECUTION_LOGLEVEL SET LOGLEVEL='{0}'\
                   WHERE SUBSYSTEM='LOG_SUB_SIPCC'".format(value)
-        _ = self._exec_sql(sqlcmd)
+        self._sipcc_loglevel = None
+        _, value = self._exec_sqls((sqlcmd, self.SQL_SIPCC_LOGLEVEL))
+        self._sipcc_loglevel = self._parse_sipcc_loglevel(value)
 
     def capture_start(self):
         """Turns on Debug loglevel for 'LOG_SUB_SIPCC' subsystem.
@@ -746,7 +1175,8 @@ class ASBCE(object):
         if self.mock:
             self.capture_active = True
             return True
-        value = "".join((self.sipcc_loglevel[:2], "1", self.sipcc_loglevel[3:]))
+        current = self.sipcc_loglevel
+        value = "".join((current[:2], "1", current[3:]))
         self.sipcc_loglevel = value
         if self.sipcc_loglevel == value:
             self.capture_active = True
@@ -762,7 +1192,8 @@ class ASBCE(object):
         if self.mock:
             self.capture_active = False
             return True
-        value = "".join((self.sipcc_loglevel[:2], "0", self.sipcc_loglevel[3:]))
+        current = self.sipcc_loglevel
+        value = "".join((current[:2], "0", current[3:]))
         self.sipcc_loglevel = value
         if self.sipcc_loglevel == value:
             self.capture_active = False
@@ -794,6 +1225,15 @@ class ASBCE(object):
         self.lastflows_timestamp = datetime.now()
         return self.lastflows
 
+    def flowtable(self):
+        """Returns the flows as a FlowTable, which holds them in columns
+        without a Flow instance per flow.
+
+        Returns:
+            FlowTable: FlowTable instance of the current flows
+        """
+        return FlowTable().load(self.showflow())
+
     def _flowtodict(self, f):
         """Converts flow string to dict.
 
@@ -803,6 +1243,9 @@ class ASBCE(object):
         Returns:
             dict: flow field names and values
         """
+        flow = parse_flow(f, self.Flow)
+        if flow is not None:
+            return flow._asdict()
         m = self.reFlow.search(f)
         if m:
             return self._fmtflow(m.groupdict())
@@ -810,18 +1253,19 @@ class ASBCE(object):
 
     def flows(self):
         """Returns the flows as dict where a key is the SBCE IP and port
-        of a flow and the value is the Flow values as namedtuple.
+        of a flow and the value is the Flow values as namedtuple. The Flow
+        instances of the flows already known are updated in place.
 
         Returns:
             dict: SBCE IP and port tuple as key and Flow instance as value
         """
-        self.lastflows = {(f.InDstIP, f.InDstPort):f for f in
-                          (self._flow(x) for x in self.showflow())}
-        self.lastflows_timestamp = datetime.now()
+        self.lastflows = self.collector.tick()
+        self.lastflows_timestamp = self.collector.timestamp
         return self.lastflows
 
     def _flow(self, f):
-        """Converts flow string to Flow class instance.
+        """Converts flow string to Flow class instance. The line is parsed
+        by parse_flow and by the RE_FLOW regex if parse_flow cannot.
 
         Args:
             f (str): flow line from list returned by showflow
@@ -829,12 +1273,17 @@ class ASBCE(object):
         Returns:
             Flow: Flow class instance
         """
+        flow = parse_flow(f, self.Flow)
+        if flow is not None:
+            return flow
         m = self.reFlow.search(f)
         return self.Flow(**self._fmtflow(m.groupdict())) if m else ()
 
     def flow(self, asbce_ip, asbce_port):
         """Combines and returns stats for flow identified by
-        asbce_ip and asbce_port.
+        asbce_ip and asbce_port. The flows are looked up in the snapshot
+        of the flow collector, "showflow" is run only if it is older than
+        the collector's interval.
 
         Args:
             asbce_ip (str): SBCE audio ip address of flow
@@ -843,13 +1292,10 @@ class ASBCE(object):
         Returns:
             dict(): {<ifaceA>: Flow, <ifaceB>: Flow}
         """
-        flows = self.flows()
-        fwdflow = flows.get((asbce_ip, asbce_port), {})
-        if fwdflow:
-            revflow = flows.get((fwdflow.OutSrcIP, fwdflow.OutSrcPort), {})
-            return ({fwdflow.InIf: fwdflow, revflow.InIf: revflow}
-                    if revflow else {fwdflow.InIf: fwdflow})
-        return {}
+        flow = self.collector.flow(asbce_ip, asbce_port)
+        self.lastflows = self.collector.flows
+        self.lastflows_timestamp = self.collector.timestamp
+        return flow
 
     @staticmethod
     def _fmtflow(flowdict, hex=False):
@@ -864,7 +1310,7 @@ class ASBCE(object):
             dict: formated flowdict
         """
         for k in ("InIf", "OutIf"):
-            flowdict[k] = {"0":"A1", "1":"A2", "2":"B1", "3":"B2"}.get(flowdict[k], "?")
+            flowdict[k] = FLOW_IFACES.get(flowdict[k], "?")
         for k in ("InSrcPort", "InDstPort", "OutSrcPort", "OutDstPort"):
             flowdict[k] = int(flowdict[k])
         if not hex:
@@ -873,22 +1319,39 @@ class ASBCE(object):
         return flowdict
 
     def _exec_sql(self, sqlcmd):
-        """Helper funtion to build SQL command.
+        """Helper funtion to execute a single SQL command.
 
         Args:
             sqlcmd (str): executable SQL command string
 
         Returns:
-            str: return value of self._exec_cmd
+            str: output of the SQL command
         """
-        if os.path.isdir("/var/lib/pgsql/"):
-            cmd = " ".join(("psql -t -U postgres sbcedb -c \"", sqlcmd, "\""))
-        else:
+        return self._exec_sqls((sqlcmd,))[0]
+
+    def _exec_sqls(self, sqlcmds):
+        """Helper funtion to execute SQL commands. With PostgreSQL these
+        are run in one batch by a psql coprocess kept open for the
+        lifetime of the instance, with solsql one by one.
+
+        Args:
+            sqlcmds (iterable): executable SQL command strings
+
+        Returns:
+            list: output of the SQL commands in the same order
+        """
+        if self._sql is None and os.path.isdir("/var/lib/pgsql/"):
+            self._sql = SQLSession(self.PSQL_CMD)
+        if self._sql is not None:
+            return self._sql.execute(sqlcmds)
+        outputs = []
+        for sqlcmd in sqlcmds:
             cmd = " ".join(
                 ("solsql -a -x onlyresults -e \"", sqlcmd, "\"",
                  "\"tcp {0} 1320\" savon savon".format(self.ems_ip))
             )
-        return self._exec_cmd(cmd).strip()
+            outputs.append(self._exec_cmd(cmd).strip())
+        return outputs
 
     @staticmethod
     def _exec_cmd(cmd):
@@ -903,7 +1366,8 @@ class ASBCE(object):
         Raises:
             RuntimeError: if the SQL bash command returns error
         """
-        proc = Popen(shlex.split(cmd), shell=False, stdout=PIPE, stderr=PIPE)
+        proc = Popen(shlex.split(cmd), shell=False, stdout=PIPE, stderr=PIPE,
+                     universal_newlines=True)
         data, err = proc.communicate()
         if proc.returncode == 0:
             return data
@@ -914,9 +1378,438 @@ class ASBCE(object):
         if not self.mock:
             self.sipcc_loglevel = self.sipcc_loglevel_inital
 
+    def watch(self, interval=None):
+        """Starts a TopologyWatcher to keep the interface and SIP server
+        maps of the instance up to date.
+
+        Args:
+            interval (float, optional): seconds between two checks
+
+        Returns:
+            TopologyWatcher: the started watcher
+        """
+        watcher = TopologyWatcher(self, interval or TopologyWatcher.INTERVAL)
+        watcher.start()
+        return watcher
+
+    def close(self):
+        """Closes the SQL coprocess if there is one."""
+        if self._sql is not None:
+            self._sql.close()
+            self._sql = None
+
+
+class TopologyWatcher(object):
+    """Keeps the interface and SIP server maps of an ASBCE up to date.
+
+    A cheap signature of each table, its row count and the range of its
+    addresses, is queried in one batch per interval, and only the tables
+    whose signature has changed are queried again. The new maps, and the
+    ones derived from the interfaces, are all built aside and swapped in
+    only once they were all built, so that the lookups of the monitoring
+    threads need no lock and see either the old or the new map, never one
+    half updated. The new signatures are kept only once the maps were
+    swapped in, so a failed refresh is retried at the next poll. Changes
+    which leave the signature intact, like renaming a SIP server, are
+    picked up only by a restart.
+    """
+    INTERVAL = 30.0
+    QUERIES = {
+        "signaling_ifaces": (ASBCE.SQL_SIGNALING_IFACES,
+                             ASBCE._parse_signaling_ifaces),
+        "media_ifaces": (ASBCE.SQL_MEDIA_IFACES, ASBCE._parse_media_ifaces),
+        "servers": (ASBCE.SQL_SERVERS, ASBCE._parse_servers),
+    }
+
+    def __init__(self, asbce, interval=INTERVAL):
+        """Initializes TopologyWatcher instance.
+
+        Args:
+            asbce (ASBCE): ASBCE instance whose maps are kept up to date
+            interval (float, optional): seconds between two checks
+
+        Returns:
+            obj: TopologyWatcher instance
+        """
+        self.asbce = asbce
+        self.interval = interval
+        self.signatures = None
+        self.error = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def poll(self):
+        """Queries the signatures and refreshes the tables which changed.
+        The first poll compares them with the signatures the maps of the
+        ASBCE were queried or loaded with.
+
+        Returns:
+            list: names of the refreshed maps
+        """
+        names = [name for name, _ in ASBCE.SQL_SIGNATURES]
+        outputs = self.asbce._exec_sqls(
+            [sql for _, sql in ASBCE.SQL_SIGNATURES])
+        signatures = dict(zip(names, outputs))
+        previous = self.signatures or self.asbce.topology_signatures or {}
+        changed = [x for x in names
+                   if previous.get(x, signatures[x]) != signatures[x]]
+        if changed:
+            self.refresh(changed)
+        self.signatures = signatures
+        self.asbce.topology_signatures = signatures
+        if changed and self.asbce.cache:
+            try:
+                self.asbce.save_topology()
+            except Exception:
+                pass
+        return changed
+
+    def refresh(self, names):
+        """Queries the maps in names in one batch and swaps them in. The
+        maps derived from the interfaces are built aside as well, nothing
+        is swapped in unless all of them were built, so that a failed
+        refresh leaves the old maps in place to be retried.
+
+        Args:
+            names (list): names of maps, keys of QUERIES
+
+        Returns:
+            None
+        """
+        outputs = self.asbce._exec_sqls([self.QUERIES[x][0] for x in names])
+        maps = dict((name, self.QUERIES[name][1](output))
+                    for name, output in zip(names, outputs))
+        if "signaling_ifaces" in maps or "media_ifaces" in maps:
+            signaling_ifaces = maps.get("signaling_ifaces",
+                                        self.asbce.signaling_ifaces)
+            media_ifaces = maps.get("media_ifaces", self.asbce.media_ifaces)
+            publics = ASBCE._build_publics(signaling_ifaces, media_ifaces)
+            ifaces = ASBCE._build_ifaces(publics)
+            maps.update({"publics": publics, "ifaces": ifaces,
+                         "mgmt_ip": ASBCE._build_mgmt_ip(ifaces)})
+        for name, value in maps.items():
+            setattr(self.asbce, "_" + name, value)
+
+    def run(self):
+        """Polls every interval seconds until stopped. A failed poll is
+        retried at the next interval, its exception is kept in error
+        until a poll succeeds."""
+        while not self.stopped.is_set():
+            try:
+                self.poll()
+                self.error = None
+            except Exception as e:
+                self.error = e
+            self.stopped.wait(self.interval)
+
+    def start(self):
+        """Starts polling in a daemon thread."""
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stops polling and waits for the thread to finish."""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+class FlowCollector(object):
+    """Collects the flows of an SBCE running "showflow" once per tick.
+
+    The Flow instances of the snapshot are updated in place from one tick
+    to the next and the deltas of their Rx, Snt and Drp counters are kept
+    as per second rates, so that the counters of hundreds of calls can be
+    polled without running "showflow" for every lookup.
+    """
+    COUNTERS = ("Rx", "Snt", "Drp")
+    IDENTITY = ("InIf", "InSrcIP", "InSrcPort", "OutIf", "OutSrcIP",
+                "OutSrcPort", "OutDstIP", "OutDstPort")
+    VALUES = ("InVlan", "OutVlan", "Enc", "Dec", "Snt", "Drp", "Rx", "Rly",
+              "Ech")
+
+    def __init__(self, asbce, interval=1.0):
+        """Initializes FlowCollector instance.
+
+        Args:
+            asbce (ASBCE): ASBCE instance to run "showflow" with
+            interval (float, optional): seconds a snapshot is used for the
+                lookups before "showflow" is run again
+
+        Returns:
+            obj: FlowCollector instance
+        """
+        self.asbce = asbce
+        self.interval = interval
+        self.fed = False
+        self.flows = {}
+        self.rates = {}
+        self.timestamp = None
+        self._clock = None
+
+    def tick(self, lines=None):
+        """Runs "showflow" once, updates the flows and their rates.
+
+        Args:
+            lines (list, optional): "showflow" output lines to use instead
+                of running it, for callers which run it themselves
+
+        Returns:
+            dict: SBCE IP and port tuple as key and Flow instance as value
+        """
+        now = time.time()
+        elapsed = now - self._clock if self._clock is not None else 0
+        seen = set()
+        if lines is None:
+            lines = self.asbce.showflow()
+        for line in lines:
+            new = self.asbce._flow(line)
+            if not new:
+                continue
+            key = (new.InDstIP, new.InDstPort)
+            seen.add(key)
+            flow = self.flows.get(key)
+            if flow is None or any(getattr(flow, k) != getattr(new, k)
+                                   for k in self.IDENTITY):
+                self.flows[key] = new
+                self.rates.pop(key, None)
+                continue
+            if elapsed > 0:
+                self.rates[key] = FlowRate(*[
+                    self._rate(getattr(flow, k), getattr(new, k), elapsed)
+                    for k in self.COUNTERS])
+            for k in self.VALUES:
+                setattr(flow, k, getattr(new, k))
+        for key in set(self.flows).difference(seen):
+            del self.flows[key]
+            self.rates.pop(key, None)
+        self._clock = now
+        self.timestamp = datetime.now()
+        return self.flows
+
+    def refresh(self):
+        """Runs tick if the snapshot is older than the interval, unless the
+        collector is fed, that is its ticks are run by someone else with
+        the lines of "showflow"."""
+        if self.fed:
+            return
+        if self._clock is None or time.time() - self._clock >= self.interval:
+            self.tick()
+
+    def flow(self, asbce_ip, asbce_port):
+        """Combines and returns stats for flow identified by
+        asbce_ip and asbce_port from the snapshot.
+
+        Args:
+            asbce_ip (str): SBCE audio ip address of flow
+            asbce_port (int): SBCE audio RTP port of flow
+
+        Returns:
+            dict(): {<ifaceA>: Flow, <ifaceB>: Flow}
+        """
+        self.refresh()
+        fwdflow = self.flows.get((asbce_ip, asbce_port))
+        if fwdflow:
+            revflow = self.flows.get((fwdflow.OutSrcIP, fwdflow.OutSrcPort))
+            return ({fwdflow.InIf: fwdflow, revflow.InIf: revflow}
+                    if revflow else {fwdflow.InIf: fwdflow})
+        return {}
+
+    def rate(self, asbce_ip, asbce_port):
+        """Returns the packet and drop rates of the flow identified by
+        asbce_ip and asbce_port from the snapshot.
+
+        Args:
+            asbce_ip (str): SBCE audio ip address of flow
+            asbce_port (int): SBCE audio RTP port of flow
+
+        Returns:
+            FlowRate: Rx, Snt and Drp per second, None until the flow has
+                been seen by two ticks
+        """
+        self.refresh()
+        return self.rates.get((asbce_ip, asbce_port))
+
+    @staticmethod
+    def _rate(prev, curr, elapsed):
+        """Returns the per second rate of a counter, a counter lower than
+        before is taken as restarted from zero."""
+        if curr < prev:
+            return curr / elapsed
+        return (curr - prev) / elapsed
+
+
+class FlowTable(object):
+    """Columnar table of the flows of a showflow snapshot.
+
+    The ports, VLANs and counters are kept in typed arrays, one per Flow
+    field, the interface names and IP addresses in lists of interned
+    strings, and index maps (InDstIP, InDstPort) to the row of a flow.
+    The counters of two snapshots are compared column by column, so that
+    the flows of a large SBCE can be trended without a Flow instance per
+    flow and poll.
+    """
+    STR_COLUMNS = ("InIf", "InSrcIP", "InDstIP", "OutIf", "OutSrcIP",
+                   "OutDstIP")
+    reFlow = re.compile("".join(ASBCE.RE_FLOW), re.I)
+
+    def __init__(self):
+        """Initializes an empty FlowTable instance.
+
+        Returns:
+            obj: FlowTable instance
+        """
+        self.columns = {}
+        for k in Flow.__slots__:
+            self.columns[k] = [] if k in self.STR_COLUMNS else array("l")
+        self.keys = []
+        self.index = {}
+        self.clock = None
+        self.timestamp = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def load(self, lines):
+        """Loads the flows of showflow lines into the table.
+
+        Args:
+            lines (list(str)): flow lines as returned by showflow
+
+        Returns:
+            FlowTable: self
+        """
+        rows = []
+        for line in lines:
+            values = split_flow(line)
+            if values is None:
+                m = self.reFlow.search(line)
+                if not m:
+                    continue
+                flowdict = ASBCE._fmtflow(m.groupdict())
+                values = [flowdict[k] for k in Flow.__slots__]
+            rows.append(values)
+        for k, column in zip(Flow.__slots__, zip(*rows)):
+            if k in self.STR_COLUMNS:
+                self.columns[k] = list(map(intern, column))
+            else:
+                self.columns[k] = array("l", column)
+        self.keys = list(zip(self.columns["InDstIP"],
+                             self.columns["InDstPort"]))
+        self.index = dict(zip(self.keys, count()))
+        self.clock = time.time()
+        self.timestamp = datetime.now()
+        return self
+
+    def flow(self, asbce_ip, asbce_port):
+        """Returns the flow identified by asbce_ip and asbce_port.
+
+        Args:
+            asbce_ip (str): SBCE audio ip address of flow
+            asbce_port (int): SBCE audio RTP port of flow
+
+        Returns:
+            Flow: Flow class instance or None if there is no such flow
+        """
+        row = self.index.get((asbce_ip, asbce_port))
+        if row is None:
+            return None
+        return Flow(*[self.columns[k][row] for k in Flow.__slots__])
+
+    def delta(self, prev, column="Rx"):
+        """Returns the increase of a counter since the prev snapshot for
+        each row. Flows not in prev and counters lower than in prev are
+        taken as started from zero.
+
+        Args:
+            prev (FlowTable): earlier snapshot
+            column (str, optional): counter column name
+
+        Returns:
+            array: increase of the counter by row
+        """
+        rows = map(prev.index.get, self.keys, repeat(-1, len(self.keys)))
+        prevcol = prev.columns[column] + array("l", [0])
+        curr = self.columns[column]
+        deltas = list(map(sub, curr, map(prevcol.__getitem__, rows)))
+        if deltas and min(deltas) < 0:
+            deltas = [d if d >= 0 else c for d, c in zip(deltas, curr)]
+        return array("l", deltas)
+
+    def rate(self, prev, column="Rx"):
+        """Returns the per second rate of a counter since the prev snapshot
+        for each row.
+
+        Args:
+            prev (FlowTable): earlier snapshot
+            column (str, optional): counter column name
+
+        Returns:
+            array: rate of the counter by row
+        """
+        elapsed = max(self.clock - prev.clock, 1e-6)
+        return array("d", [d / elapsed for d in self.delta(prev, column)])
+
+    def rising(self, prev, column="Drp"):
+        """Returns the flows whose counter increased since the prev snapshot.
+
+        Args:
+            prev (FlowTable): earlier snapshot
+            column (str, optional): counter column name
+
+        Returns:
+            list: (InDstIP, InDstPort) tuples of the flows
+        """
+        return list(compress(self.keys, self.delta(prev, column)))
+
+
+def benchmark_showflow(nflows=10000):
+    """Prints the time it takes to parse a synthetic showflow dump of
+    nflows lines with the RE_FLOW regex and with parse_flow.
+
+    Args:
+        nflows (int, optional): number of flow lines in the dump
+
+    Returns:
+        None
+    """
+    line = ("{0} [10.10.{1}.{2}:{3} -> 10.20.{1}.{2}:{4}] OUT {5} RELAY "
+            "10.30.{1}.{2}:{6} -> 10.40.{1}.{2}:{7} mtu 1500 in VLAN 0 out "
+            "VLAN 0 Enc 0 Dec 0 Snt {8:x} Drp {9:x} Rx {10:x} Rly {8:x} "
+            "ECH 0")
+    lines = [line.format(i % 4, i // 256 % 256, i % 256, 2048 + i % 30000,
+                         35000 + i % 30000, (i + 2) % 4, 36000 + i % 30000,
+                         5004 + i % 30000, i * 50, i % 7, i * 50 + 3)
+             for i in range(nflows)]
+    reFlow = re.compile("".join(ASBCE.RE_FLOW), re.I)
+    start = time.time()
+    regex_flows = [Flow(**ASBCE._fmtflow(reFlow.search(x).groupdict()))
+                   for x in lines]
+    regex_time = time.time() - start
+    start = time.time()
+    parsed_flows = [parse_flow(x) for x in lines]
+    parse_time = time.time() - start
+    same = all(a._asdict() == b._asdict() for a, b in
+               zip(regex_flows, parsed_flows))
+    print("Flows: {0}  RE_FLOW: {1:.3f}s  parse_flow: {2:.3f}s  same: {3}"
+          .format(nflows, regex_time, parse_time, same))
+
 
 if __name__ == '__main__':
-    asbce = ASBCE()
+    if sys.argv[1:] == ["--benchmark"]:
+        benchmark_showflow()
+        sys.exit()
+    if sys.argv[1:] == ["--refresh"]:
+        asbce = ASBCE(cache=False)
+        asbce.save_topology()
+    else:
+        asbce = ASBCE()
     print(asbce.mgmt_ip)
     print(asbce.ifaces)
     print(asbce.servers)
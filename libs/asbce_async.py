@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""Asyncio live pipeline of the Avaya SBCE utilities.
+
+The trace log readers, "showflow" and the packet capture all block, so
+a monitor polling them in turn gets slower with every call it follows.
+Here each of them runs as its own asyncio task and publishes to one
+EventBus, from which the monitors consume the signaling, flow and
+capture events as they happen.
+
+Note:
+    This module requires Python 3.7+, libs/asbce.py itself is kept
+    importable by the Python 2 of the SBCE.
+"""
+import asyncio
+import shlex
+import time
+from collections import namedtuple
+from asyncio.subprocess import DEVNULL, PIPE
+
+Event = namedtuple("Event", ["source", "timestamp", "data"])
+_END = object()
+
+
+class EventBus(object):
+    """Fans out the events of the pipeline to the queues of subscribers.
+
+    The queues are bounded, when one is full its oldest event is dropped,
+    so that a slow subscriber cannot hold up the producers nor make the
+    latency of the events it gets grow without limit.
+    """
+
+    def __init__(self, maxsize=1000):
+        """Initializes EventBus instance.
+
+        Args:
+            maxsize (int, optional): size of the subscriber queues
+
+        Returns:
+            obj: EventBus instance
+        """
+        self.maxsize = maxsize
+        self.queues = []
+        self.dropped = 0
+
+    def subscribe(self):
+        """Returns a new queue receiving the events published from now on.
+
+        Returns:
+            asyncio.Queue: queue of Event instances
+        """
+        queue = asyncio.Queue(self.maxsize)
+        self.queues.append(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        """Stops publishing events to queue.
+
+        Args:
+            queue (asyncio.Queue): queue returned by subscribe
+
+        Returns:
+            None
+        """
+        self.queues.remove(queue)
+
+    def publish(self, source, data):
+        """Publishes an event to all subscribers.
+
+        Args:
+            source (str): "sip", "flows", "capture" or "error"
+            data (obj): payload of the event
+
+        Returns:
+            None
+        """
+        event = Event(source, time.time(), data)
+        for queue in self.queues:
+            if queue.full():
+                queue.get_nowait()
+                self.dropped += 1
+            queue.put_nowait(event)
+
+
+def _next(reader):
+    """Returns the next item of reader or _END, as StopIteration cannot be
+    raised through a Future."""
+    try:
+        return next(reader)
+    except StopIteration:
+        return _END
+
+
+async def tail_messages(reader, interval=0.2):
+    """Async iterator of the messages of a SsyndiSIPReader or
+    TracesbcSIPReader. The reader is run in the default executor, as it
+    blocks until a partially written message is complete, and when it has
+    no new message the task sleeps for interval seconds instead of the
+    thread.
+
+    Args:
+        reader (obj): SsyndiSIPReader or TracesbcSIPReader instance
+        interval (float, optional): seconds to wait for new log lines
+
+    Yields:
+        Msg: Msg class instance
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        msg = await loop.run_in_executor(None, _next, reader)
+        if msg is _END:
+            return
+        if msg is None:
+            await asyncio.sleep(interval)
+        else:
+            yield msg
+
+
+class FlowPoller(object):
+    """Runs "showflow" as an asyncio subprocess every interval seconds
+    and feeds its output to a FlowCollector, publishing the flows and
+    their rates as "flows" events. While the poller runs the collector
+    is fed, it does not run "showflow" by itself for the lookups.
+    """
+
+    def __init__(self, asbce, bus, interval=1.0, cmd=None, collector=None):
+        """Initializes FlowPoller instance.
+
+        Args:
+            asbce (ASBCE): ASBCE instance
+            bus (EventBus): bus to publish to
+            interval (float, optional): seconds between two "showflow"
+            cmd (str, optional): command to run instead of "showflow"
+            collector (FlowCollector, optional): collector to feed, by
+                default the collector of asbce, so that asbce.flow()
+                lookups use the snapshots of the poller
+
+        Returns:
+            obj: FlowPoller instance
+        """
+        self.bus = bus
+        self.interval = interval
+        self.cmd = cmd or "showflow {0} dynamic 9".format(asbce.hardware)
+        self.collector = collector or asbce.collector
+
+    async def showflow(self):
+        """Runs the "showflow" command without blocking the loop.
+
+        Returns:
+            list: flows in list, one flow line per list item
+
+        Raises:
+            RuntimeError: if the command returns error
+        """
+        proc = await asyncio.create_subprocess_exec(
+            *shlex.split(self.cmd), stdout=PIPE, stderr=PIPE)
+        data, err = await proc.communicate()
+        if proc.returncode != 0:
+            raise RuntimeError(err.decode(errors="replace"))
+        return [x.strip() for x in
+                data.decode(errors="replace").splitlines()]
+
+    async def run(self):
+        """Polls until cancelled, a failed "showflow" is published as an
+        "error" event and retried at the next interval."""
+        loop = asyncio.get_running_loop()
+        self.collector.fed = True
+        try:
+            while True:
+                start = loop.time()
+                try:
+                    lines = await self.showflow()
+                except (OSError, RuntimeError) as e:
+                    self.bus.publish("error", e)
+                else:
+                    flows = self.collector.tick(lines)
+                    self.bus.publish("flows",
+                                     (flows, dict(self.collector.rates)))
+                await asyncio.sleep(
+                    max(0, self.interval - (loop.time() - start)))
+        finally:
+            self.collector.fed = False
+
+
+class CaptureManager(object):
+    """Turns the SIPCC debug capture of an ASBCE on and off, and runs an
+    optional packet capture command, like tcpdump, along with it. The
+    blocking SQL of ASBCE.capture_start and capture_stop is run in the
+    default executor and the changes of state are published as "capture"
+    events.
+    """
+
+    def __init__(self, asbce, bus, cmd=None):
+        """Initializes CaptureManager instance.
+
+        Args:
+            asbce (ASBCE): ASBCE instance
+            bus (EventBus): bus to publish to
+            cmd (str, optional): packet capture command
+
+        Returns:
+            obj: CaptureManager instance
+        """
+        self.asbce = asbce
+        self.bus = bus
+        self.cmd = cmd
+        self.proc = None
+        self.returncode = None
+        self._waiter = None
+
+    @property
+    def state(self):
+        """dict: Returns the state of the SIPCC and packet captures."""
+        return {"sipcc": self.asbce.capture_active,
+                "pid": self.proc.pid if self.proc else None,
+                "returncode": self.returncode}
+
+    async def start(self):
+        """Starts the captures.
+
+        Returns:
+            bool: True if the SIPCC capture was turned on, False otherwise
+        """
+        loop = asyncio.get_running_loop()
+        ok = await loop.run_in_executor(None, self.asbce.capture_start)
+        if self.cmd and self.proc is None:
+            self.returncode = None
+            self.proc = await asyncio.create_subprocess_exec(
+                *shlex.split(self.cmd), stdout=DEVNULL, stderr=DEVNULL)
+            self._waiter = asyncio.ensure_future(self._wait(self.proc))
+        self.bus.publish("capture", self.state)
+        return ok
+
+    async def _wait(self, proc):
+        """Publishes the exit of the packet capture command."""
+        self.returncode = await proc.wait()
+        if self.proc is proc:
+            self.proc = None
+        self.bus.publish("capture", self.state)
+
+    async def stop(self):
+        """Stops the captures.
+
+        Returns:
+            bool: True if the SIPCC capture was turned off, False otherwise
+        """
+        if self.proc is not None and self.proc.returncode is None:
+            self.proc.terminate()
+        if self._waiter is not None:
+            await self._waiter
+            self._waiter = None
+        loop = asyncio.get_running_loop()
+        ok = await loop.run_in_executor(None, self.asbce.capture_stop)
+        self.bus.publish("capture", self.state)
+        return ok
+
+
+class LivePipeline(object):
+    """Runs the trace log readers, the FlowPoller and the CaptureManager
+    of an ASBCE concurrently, all publishing to one EventBus.
+
+    Example:
+        pipeline = LivePipeline(asbce, [SsyndiSIPReader()])
+        events = pipeline.bus.subscribe()
+        asyncio.ensure_future(consume(events))
+        await pipeline.run()
+    """
+
+    def __init__(self, asbce, readers=(), flow_interval=1.0,
+                 showflow_cmd=None, capture_cmd=None, maxsize=1000,
+                 collector=None):
+        """Initializes LivePipeline instance.
+
+        Args:
+            asbce (ASBCE): ASBCE instance
+            readers (iterable, optional): SsyndiSIPReader or
+                TracesbcSIPReader instances
+            flow_interval (float, optional): seconds between two "showflow"
+            showflow_cmd (str, optional): command to run instead of
+                "showflow"
+            capture_cmd (str, optional): packet capture command
+            maxsize (int, optional): size of the subscriber queues
+            collector (FlowCollector, optional): see FlowPoller
+
+        Returns:
+            obj: LivePipeline instance
+        """
+        self.bus = EventBus(maxsize)
+        self.readers = list(readers)
+        self.poller = FlowPoller(asbce, self.bus, flow_interval,
+                                 showflow_cmd, collector)
+        self.capture = CaptureManager(asbce, self.bus, capture_cmd)
+
+    async def _pump(self, reader):
+        """Publishes the messages of reader as "sip" events."""
+        async for msg in tail_messages(reader):
+            self.bus.publish("sip", msg)
+
+    async def run(self, duration=None):
+        """Runs the pipeline for duration seconds, or until the readers
+        reach the end of their logfiles if they were given any, or until
+        cancelled. The captures are stopped in any case.
+
+        Args:
+            duration (float, optional): seconds to run
+
+        Returns:
+            None
+        """
+        await self.capture.start()
+        pumps = [asyncio.ensure_future(self._pump(x)) for x in self.readers]
+        poller = asyncio.ensure_future(self.poller.run())
+        try:
+            await asyncio.wait(pumps or [poller], timeout=duration)
+        finally:
+            for task in pumps + [poller]:
+                task.cancel()
+            await asyncio.gather(*(pumps + [poller]), return_exceptions=True)
+            await self.capture.stop()
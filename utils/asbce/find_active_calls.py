@@ -20,11 +20,21 @@ except:
 import re
 import string
 import sys
+import time
 from collections import deque
 from datetime import datetime, timedelta
 from glob import glob
+from itertools import izip
 from operator import itemgetter
 from optparse import OptionParser, SUPPRESS_HELP
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
 
 DESCRIPTION='''
 Parses the Avaya SBCE SSYNDI debug logs and returns a list of calls which may 
@@ -33,8 +43,14 @@ minimum duration, which is 60 mins by default.It requires  Debug level logging
 enabled for subsystem: LOG_SUB_SIP_B2B, LOG_SUB_SIPCC and LOG_SUB_SsCommon.   
 False positives are possible on busy systems when logging becomes unreliable.
 '''
-VERSION=0.2
+VERSION=0.3
 GT=60
+MENTIONS=100
+CHUNKSIZE=1048576
+FOLLOW=10
+HEADERS=("From:", "f:", "To:", "t:", "Call-ID:", "i:")
+MARKERS=("ipcssipcTotalActiveCalls", "sip_call_leg_t Call Leg id",
+         "local_tag is", "is destroyed leg_count")
 
 class linehistory(object):
     '''General purpose buffer which retains the last 'histlen' num of lines.'''
@@ -52,6 +68,70 @@ class linehistory(object):
         self.history.clear()
 
 
+class Ledger(object):
+    '''
+    Active call ledger, the state of gen_counter_events and the calls still
+    active along with how far each SSYNDI file has been read, so that it can
+    be checkpointed to a file and later runs resume from where it left off.
+    '''
+    
+    def __init__(self):
+        self.ctxid_to_tag = {}
+        self.tag_to_callinfo = {}
+        self.mentions = deque(maxlen=MENTIONS)
+        self.callid, self.from_tag, self.from_num = None, None, ""
+        self.calls = {}
+        self.calls_seen = 0
+        self.timestamp = None
+        self.offsets = {}
+    
+    @classmethod
+    def load(cls, path):
+        '''Returns the Ledger checkpointed to path or a new one.'''
+        
+        ledger = cls()
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                ledger.__dict__.update(pickle.load(f))
+        return ledger
+    
+    def save(self, path):
+        '''Checkpoints the ledger to path, replacing it atomically.'''
+        
+        for filename in list(self.offsets):
+            if not os.path.exists(filename):
+                del self.offsets[filename]
+        tmpfile = path + ".tmp"
+        with open(tmpfile, "wb") as f:
+            pickle.dump(self.__dict__, f, 2)
+        os.rename(tmpfile, path)
+    
+    def pending(self, ssyndi_files):
+        '''Generates the ssyndi_files with new data and where it starts.'''
+        
+        for filename in ssyndi_files:
+            offset = self.offsets.get(os.path.abspath(filename), 0)
+            size = os.path.getsize(filename)
+            if size < offset:
+                offset = 0
+            if size > offset:
+                yield filename, offset
+    
+    def advance(self, filename, offset):
+        self.offsets[os.path.abspath(filename)] = offset
+    
+    def update(self, action, callinfo):
+        '''Adds or removes the call of a counter event from the calls.'''
+        
+        timestamp, callid, from_num = callinfo
+        if action == "Incrementing":
+            self.calls[callid] = (timestamp, from_num)
+            self.calls_seen += 1
+        elif action == "Decrementing":
+            self.calls.pop(callid, None)
+        self.timestamp = timestamp
+
+
 def strptime(s):
     '''
     Returns a datetime object from an ASBCE's timestamp string.
@@ -85,8 +165,86 @@ def ssyndi_opener(ssyndi_files, show_progress=True):
         with open(filename, "rt") as f:
             yield f
 
-def gen_counter_events(ssyndi_files, show_progress=True):
-    '''Generates ipcssipcTotalActiveCalls events with callid, caller number'''
+def read_ssyndi(filename, offset=0):
+    '''
+    Generates the complete lines of filename from offset in lists of about
+    CHUNKSIZE bytes, together with the offset following each list. A last
+    line still being written is left for the next read.
+    '''
+    
+    with open(filename, "rt") as f:
+        f.seek(offset)
+        while True:
+            lines = f.readlines(CHUNKSIZE)
+            if not lines:
+                break
+            end = f.tell()
+            if not lines[-1].endswith("\n"):
+                end -= len(lines.pop())
+                if lines:
+                    yield lines, end
+                break
+            yield lines, end
+
+def ledger_opener(ssyndi_files, ledger, show_progress=True):
+    '''
+    Generates the lists of lines of each ssyndi_file not yet in the ledger,
+    the ledger is advanced past a list when the next one is asked for.
+    '''
+    
+    for filename, offset in ledger.pending(ssyndi_files):
+        if show_progress:
+            print("Processing: {0}".format(filename), end="\r")
+        for lines, end in read_ssyndi(filename, offset):
+            yield lines
+            ledger.advance(filename, end)
+
+def prefilter_ssyndi(task):
+    '''
+    Returns the lines of filename from offset gen_counter_events acts upon,
+    that is the From/To/Call-ID header lines and the lines with any of the
+    MARKERS, and the offset following the last complete line.
+    '''
+    
+    filename, offset = task
+    header_chars = frozenset(header[0] for header in HEADERS)
+    marker1, marker2, marker3, marker4 = MARKERS
+    filtered = []
+    for lines, offset in read_ssyndi(filename, offset):
+        for line in lines:
+            if ((line[:1] in header_chars and line.startswith(HEADERS)) or
+                marker1 in line or marker2 in line or
+                marker3 in line or marker4 in line):
+                filtered.append(line)
+    return "".join(filtered), offset
+
+def prefiltered_opener(ssyndi_files, jobs, ledger, show_progress=True):
+    '''
+    Generates the lines of each ssyndi_file not yet in the ledger prefiltered
+    by a pool of "jobs" processes, in the order of the files. The ledger is
+    advanced past a file when the next one is asked for.
+    '''
+    
+    tasks = list(ledger.pending(ssyndi_files))
+    if not tasks:
+        return
+    pool = multiprocessing.Pool(min(jobs, len(tasks)))
+    try:
+        for (filename, offset), (lines, end) in izip(tasks,
+                                        pool.imap(prefilter_ssyndi, tasks)):
+            if show_progress:
+                print("Processing: {0}".format(filename), end="\r")
+            yield lines.splitlines(True)
+            ledger.advance(filename, end)
+        pool.close()
+    finally:
+        pool.terminate()
+
+def gen_counter_events_history(ssyndi_files, show_progress=True):
+    '''
+    Generates ipcssipcTotalActiveCalls events with callid, caller number
+    by rescanning the last 210 lines at each event, kept for --benchmark.
+    '''
     
     line_history = None
     ctxid_to_tag = {}
@@ -177,6 +335,147 @@ def gen_counter_events(ssyndi_files, show_progress=True):
         
         line_history = lines.history
 
+def tag_of(line):
+    '''Returns the tag parameter of a From or To header line or None.'''
+    
+    parts = line.split("tag=")
+    if len(parts) > 1:
+        return parts[1].strip()
+    return None
+
+def gen_counter_events(ssyndi_files, show_progress=True, jobs=1, ledger=None):
+    '''
+    Generates ipcssipcTotalActiveCalls events with callid, caller number.
+    The tags, Call-IDs and ctxids are recorded in dicts as their lines go
+    by and the tags seen most recently are queued in "mentions", so each
+    counter event is resolved by lookups instead of a rescan of the lines.
+    With more than one "jobs" the files are prefiltered in parallel, as the
+    other lines do not change the outcome. The state is kept in the ledger,
+    which is resumed from and advanced past the lines processed.
+    '''
+    
+    if ledger is None:
+        ledger = Ledger()
+    ctxid_to_tag = ledger.ctxid_to_tag
+    tag_to_callinfo = ledger.tag_to_callinfo
+    mentions = ledger.mentions
+    callid, from_tag, from_num = ledger.callid, ledger.from_tag, ledger.from_num
+    reTags = re.compile(r"local_tag is (.*) and mRemoteTag is (.*)#")
+    all = string.maketrans("", "")
+    nodigs = all.translate(all, string.digits)
+    headers = HEADERS
+    header_chars = frozenset(header[0] for header in headers)
+    ctxid_in_created_line = slice(86, 93)
+    ctxid_in_destroy_line = slice(87, 94)
+    timestamp_slice = slice(1, 27)
+    
+    if jobs > 1 and multiprocessing is not None:
+        opener = prefiltered_opener(ssyndi_files, jobs, ledger, show_progress)
+    else:
+        opener = ledger_opener(ssyndi_files, ledger, show_progress)
+    
+    for lines in opener:
+        for line in lines:
+            
+            if line[:1] in header_chars and line.startswith(headers):
+                if line.startswith(("Call-ID:", "i:")):
+                    callid = line.split()[1].strip()
+                
+                elif line.startswith(("From:", "f:")):
+                    from_tag = tag_of(line)
+                    start = line.find("<")
+                    end = line.find("@", start)
+                    from_num = line[start:end].translate(all, nodigs)
+                    mentions.append(from_tag)
+                
+                else:
+                    mentions.append(tag_of(line))
+            
+            elif "ipcssipcTotalActiveCalls" in line:
+                if "Incrementing counter ipcssipcTotalActiveCalls" in line:
+                    callinfo = (line[timestamp_slice], callid, from_num)
+                    tag_to_callinfo[from_tag] = callinfo
+                    yield "Incrementing", callinfo
+                
+                elif "Decrementing counter ipcssipcTotalActiveCalls" in line:
+                    for i in xrange(len(mentions) - 1, -1, -1):
+                        tag = mentions[i]
+                        if tag in tag_to_callinfo:
+                            yield "Decrementing", tag_to_callinfo.pop(tag)
+                            break
+            
+            elif "sip_call_leg_t Call Leg id" in line:
+                ctxid = line[ctxid_in_created_line]
+                if ctxid not in ctxid_to_tag:
+                    ctxid_to_tag[ctxid] = from_tag
+            
+            elif "local_tag is" in line:
+                m = reTags.search(line[32:])
+                if m:
+                    loc_tag, rem_tag = m.groups()
+                    mentions.append(rem_tag)
+                    mentions.append(loc_tag)
+            
+            elif "is destroyed leg_count" in line:
+                ctxid = line[ctxid_in_destroy_line]
+                mentions.append(ctxid_to_tag.pop(ctxid, None))
+        
+        ledger.callid, ledger.from_tag = callid, from_tag
+        ledger.from_num = from_num
+
+def benchmark(ssyndi_files, jobs=1):
+    '''
+    Prints the time it takes to correlate the counter events of the SSYNDI
+    files with the line history rescans, with the forward correlator and
+    with the forward correlator over files prefiltered by "jobs" processes.
+    '''
+    
+    ssyndi_files = list(ssyndi_files)
+    size = sum(os.path.getsize(x) for x in ssyndi_files) / 1048576.0
+    out = "{0:<8} {1:8d} events {2:8d} decrements {3:9.1f} MB {4:8.2f}s " \
+          "{5:8.1f} MB/s"
+    runs = [("History", gen_counter_events_history, ()),
+            ("Forward", gen_counter_events, ())]
+    if jobs > 1:
+        runs.append(("Parallel", gen_counter_events, (jobs,)))
+    for name, gen, extra in runs:
+        start = time.time()
+        events, decrements = 0, 0
+        for action, callinfo in gen(ssyndi_files, False, *extra):
+            events += 1
+            if action == "Decrementing":
+                decrements += 1
+        elapsed = max(time.time() - start, 1e-6)
+        print(out.format(name, events, decrements, size, elapsed,
+                         size / elapsed))
+
+def report(ledger, opts, show_progress=True):
+    '''Prints the calls of the ledger active for longer than opts.gt.'''
+    
+    if not ledger.calls:
+        return
+    
+    line_no = 1
+    last_ts_strptime = strptime(ledger.timestamp)
+    delta = timedelta(minutes=opts.gt)
+    title = "ACTIVE CALLS WITH DURATION >{0}MINS FROM THE {1} CALLS SEEN"
+    callinfo = "{0:3d}. Since {1}  with  Call-ID {2}  From {3}"
+    
+    if show_progress:
+        print("\n\n##### ", title.format(opts.gt, ledger.calls_seen),
+              " #####\n")
+    
+    filtered = filter(lambda (c,(t,f)): last_ts_strptime-strptime(t) > delta,
+                                                    ledger.calls.iteritems())
+    for callid, (timestamp, from_num) in sorted(filtered, key=itemgetter(1)):
+        if opts.callids:
+            print(callid)
+        elif opts.froms:
+            print(from_num)
+        else:
+            print(callinfo.format(line_no, timestamp, callid, from_num))
+            line_no +=1
+
 def main():
     parser = OptionParser(
         usage="%prog [<options>] [SSYNDI log files]",
@@ -211,12 +510,42 @@ def main():
         metavar=" ",
         help="to turn on verbose output")
     
+    parser.add_option("-j", "--jobs",
+        action="store",
+        default=1,
+        dest="jobs",
+        type="int",
+        metavar=" ",
+        help="number of processes prefiltering the SSYNDI files in\
+             parallel, the result is the same as of one. The default is 1.")
+    
+    parser.add_option("-l", "--ledger",
+        action="store",
+        default=False,
+        dest="ledger",
+        metavar=" ",
+        help="active call ledger file, the state is resumed from it and\
+             checkpointed to it so that later runs process only new logs")
+    
+    parser.add_option("--follow",
+        action="store_true",
+        default=False,
+        dest="follow",
+        metavar=" ",
+        help="keep following the SSYNDI logs and report the active calls\
+             every {0} seconds".format(FOLLOW))
+    
+    parser.add_option("-b", "--benchmark",
+        action="store_true",
+        default=False,
+        dest="benchmark",
+        metavar=" ",
+        help=SUPPRESS_HELP)
+    
     opts, args = parser.parse_args()
     
-    if not args:
-        ssyndi_files = find_ssyndis()
-    else:
-        ssyndi_files = args
+    if opts.benchmark:
+        return benchmark(args or find_ssyndis(), opts.jobs)
     
     if opts.gt:
         opts.gt = int(opts.gt)
@@ -228,48 +557,30 @@ def main():
     else:
         show_progress = True
     
-    calls = {}
-    calls_seen = 0
+    if opts.ledger:
+        ledger = Ledger.load(opts.ledger)
+    else:
+        ledger = Ledger()
     
-    for event in gen_counter_events(ssyndi_files, show_progress):
-        action, (timestamp, callid, from_num) = event
+    while True:
+        ssyndi_files = args or list(find_ssyndis())
         
-        if action == "Incrementing":
+        for action, callinfo in gen_counter_events(ssyndi_files, show_progress,
+                                                   opts.jobs, ledger):
             if opts.verbose:
-                print("ADDED   {0}  Call-ID {1}  From {2}".format(timestamp,
-                                                           callid, from_num))
-            calls[callid] = (timestamp, from_num)
-            calls_seen +=1
+                label = {"Incrementing": "ADDED  ", "Decrementing": "DELETED"}
+                print("{0} {1}  Call-ID {2}  From {3}".format(label[action],
+                                                              *callinfo))
+            ledger.update(action, callinfo)
         
-        elif action == "Decrementing":
-            if opts.verbose:
-                timestamp, from_num = active_calls[callid]
-                print("DELETED {0}  Call-ID {1}  From {2}".format(timestamp,
-                                                           callid, from_num))
-            del calls[callid]
-    
-    if not calls:
-        return
-    
-    line_no = 1
-    last_ts_strptime = strptime(timestamp)
-    delta = timedelta(minutes=opts.gt)
-    title = "ACTIVE CALLS WITH DURATION >{0}MINS FROM THE {1} CALLS SEEN"
-    callinfo = "{0:3d}. Since {1}  with  Call-ID {2}  From {3}"
-    
-    if show_progress:
-        print("\n\n##### ", title.format(opts.gt, calls_seen), " #####\n")
-    
-    filtered = filter(lambda (c,(t,f)): last_ts_strptime-strptime(t) > delta,
-                                                           calls.iteritems())
-    for callid, (timestamp, from_num) in sorted(filtered, key=itemgetter(1)):
-        if opts.callids:
-            print(callid)
-        elif opts.froms:
-            print(from_num)
-        else:
-            print(callinfo.format(line_no, timestamp, callid, from_num))
-            line_no +=1
+        if opts.ledger:
+            ledger.save(opts.ledger)
+        
+        report(ledger, opts, show_progress)
+        
+        if not opts.follow:
+            break
+        time.sleep(FOLLOW)
 
 if __name__ == "__main__":
     try:
@@ -1,10 +1,35 @@
 #!/usr/bin/env python
+import bisect
+import errno
+import fnmatch
 import glob
 import gzip
 import os
 os.nice(19)
+import re
+import select
 import shutil
+import struct
 import sys
+import time
+import zlib
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 SRCDIR='/var/log/ecs'
 DSTDIR='/var/web'
@@ -12,6 +37,12 @@ FILES='20*'
 MAXUSE=80
 GZIP=1
 RATIO=4
+JOBS=2
+BACKLOG=10
+METRICS='backup_ecs.log'
+DAEMON=0
+BUNDLE=0
+DEDUP=0
 DEBUG=0
 
 HELP='''This script takes no argument, the configurable parameters must be 
@@ -28,6 +59,25 @@ MAXUSE Determines the maximum %% of space that can be used up on the partition
 GZIP   Determines if the backup is to be gzip compressed or not. The default
        is 1 which means it is.
 RATIO  Gzip compression level, 9 slowest/most compression, 0 no compression.
+JOBS   Number of processes compressing the log files in parallel.
+BACKLOG Number of log files waiting to be backed up at or above which the
+       fastest compression level 1 is used instead of RATIO. Half of RATIO
+       is used from half of BACKLOG or when the CPUs are half busy.
+METRICS File in DSTDIR to which a line of throughput and backlog metrics is
+       appended on each run, empty to not write any.
+DAEMON If 1 the script keeps running and backs up each log file as soon as
+       a newer one is created, it still should be started from cron which
+       then only restarts it if it is not running any longer. The backups
+       are tracked in the backup_ecs.manifest file of DSTDIR.
+BUNDLE If 1 the log files are appended to hourly bundle files, each log file
+       as a gzip member of its own, instead of being backed up into a file
+       of their own. The .ecs.idx file of each .ecs.gz bundle holds the name,
+       offset, length and first and last timestamp of the log files in it.
+       Not used with DAEMON=1.
+DEDUP  If 1 the log files are cut into chunks at content defined line
+       boundaries and each distinct chunk is stored only once, compressed,
+       in the chunks folder of DSTDIR. The manifests/ecs folder holds a
+       manifest per log file listing its chunks. Not used with DAEMON=1.
 DEBUG  This is for debugging purposes. It should be left as 0 when the script
        is run by cron.
 
@@ -39,8 +89,22 @@ FILES=%s
 MAXUSE=%s
 GZIP=%s
 RATIO=%s
+JOBS=%s
+BACKLOG=%s
+METRICS=%s
+DAEMON=%s
+BUNDLE=%s
+DEDUP=%s
 DEBUG=%s
+
+Files and folders of any other source, for example tracesbc_sip files, can be
+stored to and restored from a deduplicating store with:
+
+%s store <dstdir> <label> <file or folder>...
+%s restore <dstdir> <label> <file> [<outfile>]
 '''
+#prefix of the temporary files in DSTDIR, only these are removed at startup
+TMP_PREFIX='.backup_ecs.'
 
 def prerun_checks(srcdir, dstdir, debug=0):
     if not os.path.isdir(srcdir) and not os.path.exists(srcdir):
@@ -67,16 +131,89 @@ def disk_usage(path, debug=0):
         print 'disk_usage: %s %s' % (path, usage)
     return usage
 
+def tmp_path(dstdir, filename):
+    return os.path.join(dstdir, TMP_PREFIX + filename + '.tmp')
+
 def compress(srcfile, dstdir, compresslevel=4):
+    basename = os.path.basename(srcfile)
+    gzipfile = os.path.join(dstdir, basename + '.gz')
+    tmpfile = tmp_path(dstdir, basename + '.gz')
+    fd_in = open(srcfile, 'rb')
     try:
-        basename = os.path.basename(srcfile)
-        gzipfile = os.path.join(dstdir, basename + '.gz')
-        fd_in = open(srcfile, 'rb')
-        fd_out = gzip.open(gzipfile, 'wb', compresslevel)
-        shutil.copyfileobj(fd_in, fd_out)
+        fd_out = gzip.open(tmpfile, 'wb', compresslevel)
+        try:
+            shutil.copyfileobj(fd_in, fd_out, 1024*1024)
+        finally:
+            fd_out.close()
     finally:
         fd_in.close()
-        fd_out.close()
+    os.rename(tmpfile, gzipfile)
+    return os.path.getsize(gzipfile)
+
+def copy(srcfile, dstdir):
+    basename = os.path.basename(srcfile)
+    tmpfile = tmp_path(dstdir, basename)
+    shutil.copy2(srcfile, tmpfile)
+    os.rename(tmpfile, os.path.join(dstdir, basename))
+    return os.path.getsize(srcfile)
+
+def backup(task):
+    srcfile, dstdir, gzip, compresslevel = task
+    size = os.path.getsize(srcfile)
+    if gzip:
+        return size, compress(srcfile, dstdir, compresslevel)
+    return size, copy(srcfile, dstdir)
+
+def run_backups(pool, tasks, metrics, debug=0):
+    if pool is not None:
+        results = pool.map(backup, tasks)
+    else:
+        results = map(backup, tasks)
+    for task, (size_in, size_out) in zip(tasks, results):
+        metrics['files'] += 1
+        metrics['bytes_in'] += size_in
+        metrics['bytes_out'] += size_out
+        if debug:
+            print 'sweep: copied %s at level %s' % (task[0], task[3])
+
+def cpu_load():
+    try:
+        load = os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return 0.0
+    cpus = 1
+    if multiprocessing is not None:
+        try:
+            cpus = multiprocessing.cpu_count()
+        except NotImplementedError:
+            pass
+    return load / cpus
+
+def compress_level(backlog, load, ratio=4, maxbacklog=10):
+    if backlog >= maxbacklog or load >= 1.0:
+        return min(ratio, 1)
+    if backlog * 2 >= maxbacklog or load >= 0.5:
+        return min(ratio, max(1, ratio // 2))
+    return ratio
+
+def remove_tmpfiles(dstdir, debug=0):
+    for tmpfile in glob.glob(tmp_path(dstdir, '*')):
+        os.remove(tmpfile)
+        if debug:
+            print 'remove_tmpfiles: removed %s' % tmpfile
+
+def write_metrics(dstdir, metrics, filename, debug=0):
+    line = ('%(time)s files=%(files)d backlog=%(backlog)d skipped=%(skipped)d'
+            ' in=%(bytes_in)d out=%(bytes_out)d secs=%(secs).2f'
+            ' MB/s=%(rate).2f levels=%(levels)s load=%(load).2f' % metrics)
+    if debug:
+        print 'write_metrics: %s' % line
+    if filename:
+        fd = open(os.path.join(dstdir, filename), 'a')
+        try:
+            fd.write(line + '\n')
+        finally:
+            fd.close()
 
 def glob_files(path, files, reverse=False):
     os.chdir(path)
@@ -89,7 +226,10 @@ def glob_files(path, files, reverse=False):
             result.append(filename)
     return result
 
-def sweep(srcdir, dstdir, files, maxuse=90, gzip=1, ratio=4, debug=0):
+def sweep(srcdir, dstdir, files, maxuse=90, gzip=1, ratio=4, debug=0,
+          jobs=2, maxbacklog=10, metrics_file=None):
+    start = time.time()
+    remove_tmpfiles(dstdir, debug)
     srcfiles = glob_files(srcdir, files)[:-1]
     bkpfiles = glob_files(dstdir, files, True)
     newfiles = sorted(set(srcfiles).difference(set(bkpfiles)))
@@ -97,48 +237,758 @@ def sweep(srcdir, dstdir, files, maxuse=90, gzip=1, ratio=4, debug=0):
         print 'sweep: srcfiles 0:%s, -1:%s' % (srcfiles[:1], srcfiles[-1:])
         print 'sweep: bkpfiles 0:%s, -1:%s' % (bkpfiles[-1:], bkpfiles[:1])
         print 'sweep: newfiles 0:%s, -1:%s' % (newfiles[:1], newfiles[-1:])
-    for newfile in newfiles:
-        retried = False
-        if bkpfiles:
-            oldest = bkpfiles[-1]
-            if oldest >= newfile:
+    load = cpu_load()
+    metrics = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'files': 0,
+               'backlog': len(newfiles), 'skipped': 0, 'bytes_in': 0,
+               'bytes_out': 0, 'load': load}
+    levels = set()
+    pool = None
+    if jobs > 1 and len(newfiles) > 1 and multiprocessing is not None:
+        pool = multiprocessing.Pool(min(jobs, len(newfiles)))
+    tasks = []
+    full = False
+    try:
+        for n, newfile in enumerate(newfiles):
+            retried = False
+            if bkpfiles:
+                oldest = bkpfiles[-1]
+                if oldest >= newfile:
+                    if debug:
+                        print 'sweep: newfile is older than oldest bkp, skipping'
+                    metrics['skipped'] += 1
+                    continue
+            while disk_usage(dstdir)['percent'] >= maxuse:
+                try:
+                    oldest = bkpfiles.pop()
+                    if debug:
+                        print 'sweep: popped %s' % oldest
+                except IndexError:
+                    if retried:
+                        full = True
+                        break
+                    bkpfiles = glob_files(dstdir, files, True)
+                    retried = True
+                    if debug:
+                        print 'sweep: retrying with already copied files'
+                else:
+                    glob_oldest = os.path.join(dstdir, oldest + '*')
+                    for oldest in glob.glob(glob_oldest):
+                        os.remove(oldest)
+                    if debug:
+                        print 'sweep: removed %s' % oldest
+            if full:
+                break
+            level = compress_level(len(newfiles) - n, load, ratio, maxbacklog)
+            if gzip:
+                levels.add(level)
+            tasks.append((os.path.join(srcdir, newfile), dstdir, gzip, level))
+            if len(tasks) >= jobs:
+                run_backups(pool, tasks, metrics, debug)
+                tasks = []
+        if tasks:
+            run_backups(pool, tasks, metrics, debug)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    metrics['secs'] = time.time() - start
+    metrics['rate'] = metrics['bytes_in'] / 1048576.0 / max(metrics['secs'],
+                                                            0.001)
+    metrics['levels'] = ','.join(str(x) for x in sorted(levels)) or '-'
+    metrics['backlog'] -= metrics['files'] + metrics['skipped']
+    write_metrics(dstdir, metrics, metrics_file, debug)
+
+BUNDLE_SUFFIX = '.ecs.gz'
+INDEX_SUFFIX = '.ecs.idx'
+RE_TIMESTAMP = re.compile(r'\d{8}:\d{9}')
+
+def bundle_name(filename):
+    return filename[:12] + BUNDLE_SUFFIX
+
+def index_name(bundle):
+    return bundle[:-len(BUNDLE_SUFFIX)] + INDEX_SUFFIX
+
+def read_index(path):
+    entries = []
+    if os.path.exists(path):
+        fd = open(path)
+        try:
+            for line in fd:
+                fields = line.split()
+                if len(fields) == 5:
+                    entries.append((fields[0], int(fields[1]), int(fields[2]),
+                                    fields[3], fields[4]))
+        finally:
+            fd.close()
+    return entries
+
+def line_timestamps(data):
+    first, last = '-', '-'
+    if RE_TIMESTAMP.match(data):
+        first = data[:18]
+    tail = data.rstrip('\n')
+    tail = tail[tail.rfind('\n')+1:]
+    if RE_TIMESTAMP.match(tail):
+        last = tail[:18]
+    return first, last
+
+def compress_member(task):
+    srcfile, tmpfile, compresslevel = task
+    fd_in = open(srcfile, 'rb')
+    try:
+        data = fd_in.read()
+    finally:
+        fd_in.close()
+    fd_out = open(tmpfile, 'wb')
+    try:
+        member = gzip.GzipFile(os.path.basename(srcfile), 'wb', compresslevel,
+                               fd_out)
+        try:
+            member.write(data)
+        finally:
+            member.close()
+    finally:
+        fd_out.close()
+    first, last = line_timestamps(data)
+    return len(data), os.path.getsize(tmpfile), first, last
+
+def append_member(dstdir, bundle, tmpfile, filename, first, last, debug=0):
+    path = os.path.join(dstdir, bundle)
+    entries = read_index(os.path.join(dstdir, index_name(bundle)))
+    offset = 0
+    if entries:
+        offset = entries[-1][1] + entries[-1][2]
+    fd = open(path, 'ab')
+    try:
+        if os.path.getsize(path) != offset:
+            if debug:
+                print 'append_member: truncating %s to %s' % (path, offset)
+            fd.truncate(offset)
+        fd_in = open(tmpfile, 'rb')
+        try:
+            shutil.copyfileobj(fd_in, fd, 1024*1024)
+        finally:
+            fd_in.close()
+        fd.flush()
+        os.fsync(fd.fileno())
+    finally:
+        fd.close()
+    length = os.path.getsize(tmpfile)
+    fd = open(os.path.join(dstdir, index_name(bundle)), 'a')
+    try:
+        fd.write('%s %d %d %s %s\n' % (filename, offset, length, first, last))
+    finally:
+        fd.close()
+    os.remove(tmpfile)
+
+def bundle_tasks(pool, tasks, dstdir, metrics, debug=0):
+    if pool is not None:
+        results = pool.map(compress_member, tasks)
+    else:
+        results = map(compress_member, tasks)
+    for (srcfile, tmpfile, level), (size_in, size_out, first, last) in zip(
+                                                            tasks, results):
+        filename = os.path.basename(srcfile)
+        append_member(dstdir, bundle_name(filename), tmpfile, filename, first,
+                      last, debug)
+        metrics['files'] += 1
+        metrics['bytes_in'] += size_in
+        metrics['bytes_out'] += size_out
+        if debug:
+            print 'sweep_bundles: appended %s at level %s' % (srcfile, level)
+
+def sweep_bundles(srcdir, dstdir, files, maxuse=90, ratio=4, debug=0, jobs=2,
+                  maxbacklog=10, metrics_file=None):
+    start = time.time()
+    remove_tmpfiles(dstdir, debug)
+    srcfiles = glob_files(srcdir, files)[:-1]
+    bundles = sorted(glob.glob(os.path.join(dstdir, '*' + BUNDLE_SUFFIX)),
+                     reverse=True)
+    bundles = [os.path.basename(x) for x in bundles]
+    bundled = set()
+    for bundle in set(bundle_name(x) for x in srcfiles):
+        for entry in read_index(os.path.join(dstdir, index_name(bundle))):
+            bundled.add(entry[0])
+    newfiles = [x for x in srcfiles if x not in bundled]
+    if debug:
+        print 'sweep_bundles: bundles 0:%s, -1:%s' % (bundles[-1:], bundles[:1])
+        print 'sweep_bundles: newfiles 0:%s, -1:%s' % (newfiles[:1],
+                                                       newfiles[-1:])
+    load = cpu_load()
+    metrics = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'files': 0,
+               'backlog': len(newfiles), 'skipped': 0, 'bytes_in': 0,
+               'bytes_out': 0, 'load': load}
+    levels = set()
+    pool = None
+    if jobs > 1 and len(newfiles) > 1 and multiprocessing is not None:
+        pool = multiprocessing.Pool(min(jobs, len(newfiles)))
+    tasks = []
+    try:
+        for n, newfile in enumerate(newfiles):
+            if bundles and bundles[-1] > bundle_name(newfile):
                 if debug:
-                    print 'sweep: newfile is older than oldest bkp, skipping'
+                    print 'sweep_bundles: newfile is older than oldest bundle'
+                metrics['skipped'] += 1
                 continue
-        while disk_usage(dstdir)['percent'] >= maxuse:
-            try:
-                oldest = bkpfiles.pop()
+            full = False
+            while disk_usage(dstdir)['percent'] >= maxuse:
+                if not bundles or bundles[-1] == bundle_name(newfile):
+                    full = True
+                    break
+                oldest = bundles.pop()
+                for path in (oldest, index_name(oldest)):
+                    if os.path.exists(os.path.join(dstdir, path)):
+                        os.remove(os.path.join(dstdir, path))
                 if debug:
-                    print 'sweep: popped %s' % oldest
-            except IndexError:
-                if retried:
-                    return
-                bkpfiles = glob_files(dstdir, files, True)
-                retried = True
-                if debug:
-                    print 'sweep: retrying with already copied files'
-            else:
-                glob_oldest = os.path.join(dstdir, oldest + '*')
-                for oldest in glob.glob(glob_oldest):
-                    os.remove(oldest)
-                if debug:
-                    print 'sweep: removed %s' % oldest
-        srcfile = os.path.join(srcdir, newfile)
+                    print 'sweep_bundles: removed %s' % oldest
+            if full:
+                break
+            level = compress_level(len(newfiles) - n, load, ratio, maxbacklog)
+            levels.add(level)
+            tmpfile = tmp_path(dstdir, newfile + '.gz')
+            tasks.append((os.path.join(srcdir, newfile), tmpfile, level))
+            if len(tasks) >= jobs:
+                bundle_tasks(pool, tasks, dstdir, metrics, debug)
+                tasks = []
+        if tasks:
+            bundle_tasks(pool, tasks, dstdir, metrics, debug)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    metrics['secs'] = time.time() - start
+    metrics['rate'] = metrics['bytes_in'] / 1048576.0 / max(metrics['secs'],
+                                                            0.001)
+    metrics['levels'] = ','.join(str(x) for x in sorted(levels)) or '-'
+    metrics['backlog'] -= metrics['files'] + metrics['skipped']
+    write_metrics(dstdir, metrics, metrics_file, debug)
+
+class Manifest(object):
+    def __init__(self, path):
+        self.path = path
+        self.names = []
+        self.entries = {}
+        self.total = 0
+        self.fd = None
+        if os.path.exists(path):
+            fd = open(path)
+            try:
+                for line in fd:
+                    fields = line.split()
+                    if len(fields) == 3 and fields[0] == '+':
+                        self._add(fields[1], int(fields[2]))
+                    elif len(fields) == 2 and fields[0] == '-':
+                        self._remove(fields[1])
+            finally:
+                fd.close()
+
+    def _add(self, filename, size):
+        if filename in self.entries:
+            self._remove(filename)
+        bisect.insort(self.names, filename)
+        self.entries[filename] = size
+        self.total += size
+
+    def _remove(self, filename):
+        size = self.entries.pop(filename, None)
+        if size is not None:
+            del self.names[bisect.bisect_left(self.names, filename)]
+            self.total -= size
+
+    def _journal(self, line):
+        if self.fd is None:
+            self.fd = open(self.path, 'a')
+        self.fd.write(line)
+        self.fd.flush()
+
+    def add(self, filename, size):
+        self._add(filename, size)
+        self._journal('+ %s %d\n' % (filename, size))
+
+    def remove(self, filename):
+        self._remove(filename)
+        self._journal('- %s\n' % filename)
+
+    def srcname(self, filename):
+        if filename.endswith('.gz'):
+            return filename[:-3]
+        return filename
+
+    def oldest(self):
+        if self.names:
+            return self.srcname(self.names[0])
+        return None
+
+    def __contains__(self, srcname):
+        return srcname in self.entries or srcname + '.gz' in self.entries
+
+    def sync(self, dstdir, files):
+        listed = set(fnmatch.filter(os.listdir(dstdir), files))
+        for filename in list(self.names):
+            if filename not in listed:
+                self._remove(filename)
+        for filename in listed:
+            if filename not in self.entries:
+                self._add(filename, disk_size(os.path.join(dstdir, filename)))
+        self.compact()
+
+    def compact(self):
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
+        tmp = self.path + '.tmp'
+        fd = open(tmp, 'w')
+        try:
+            for filename in self.names:
+                fd.write('+ %s %d\n' % (filename, self.entries[filename]))
+        finally:
+            fd.close()
+        os.rename(tmp, self.path)
+
+class Inotify(object):
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    HEADER = 'iIII'
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                                use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed', path)
+        return wd
+
+    def read(self, timeout=None):
+        try:
+            ready = select.select([self.fd], [], [], timeout)[0]
+        except select.error, e:
+            if e[0] == errno.EINTR:
+                return []
+            raise
+        if not ready:
+            return []
+        buf = os.read(self.fd, 65536)
+        events, pos, size = [], 0, struct.calcsize(self.HEADER)
+        while pos < len(buf):
+            wd, mask, cookie, length = struct.unpack(self.HEADER,
+                                                     buf[pos:pos+size])
+            pos += size
+            events.append((mask, buf[pos:pos+length].rstrip('\0')))
+            pos += length
+        return events
+
+def disk_size(path):
+    st = os.stat(path)
+    if getattr(st, 'st_blocks', None):
+        return max(st.st_size, st.st_blocks * 512)
+    return st.st_size
+
+def space_budget(dstdir, manifest, maxuse, debug=0):
+    usage = disk_usage(dstdir, debug)
+    others = usage['used'] - manifest.total
+    budget = usage['total'] * maxuse // 100 - others
+    if debug:
+        print 'space_budget: %s bytes for %s bytes in %s backups' % (budget,
+              manifest.total, len(manifest.names))
+    return budget
+
+def make_room(dstdir, manifest, size, budget, debug=0):
+    while manifest.names and manifest.total + size > budget:
+        oldest = manifest.names[0]
+        try:
+            os.remove(os.path.join(dstdir, oldest))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        manifest.remove(oldest)
+        if debug:
+            print 'make_room: removed %s' % oldest
+    return manifest.total + size <= budget
+
+def backup_tasks(pool, tasks, dstdir, manifest, metrics, debug=0):
+    run_backups(pool, tasks, metrics, debug)
+    for srcfile, dstdir, gzip, level in tasks:
+        filename = os.path.basename(srcfile)
         if gzip:
-            compress(srcfile, dstdir, ratio)
-            if debug:
-                print 'sweep: copied and compressed %s' % srcfile
+            filename += '.gz'
+        manifest.add(filename, disk_size(os.path.join(dstdir, filename)))
+
+def lock_daemon(dstdir):
+    fd = open(os.path.join(dstdir, '.backup_ecs.lock'), 'w')
+    if fcntl is not None:
+        try:
+            fcntl.flock(fd.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            fd.close()
+            return None
+    return fd
+
+def daemon(srcdir, dstdir, files, maxuse=90, gzip=1, ratio=4, debug=0,
+           jobs=2, maxbacklog=10, metrics_file=None, interval=3600, poll=5):
+    lock = lock_daemon(dstdir)
+    if lock is None:
+        if debug:
+            print 'daemon: already running'
+        return 0
+    remove_tmpfiles(dstdir, debug)
+    manifest = Manifest(os.path.join(dstdir, 'backup_ecs.manifest'))
+    manifest.sync(dstdir, files)
+    budget = space_budget(dstdir, manifest, maxuse, debug)
+    srcfiles = set(fnmatch.filter(os.listdir(srcdir), files))
+    inotify = None
+    if ctypes is not None:
+        try:
+            inotify = Inotify()
+            inotify.add_watch(srcdir, Inotify.IN_CREATE | Inotify.IN_DELETE |
+                              Inotify.IN_MOVED_TO | Inotify.IN_MOVED_FROM)
+        except (AttributeError, OSError):
+            inotify = None
+    if debug:
+        print 'daemon: watching %s with %s' % (srcdir,
+              inotify and 'inotify' or 'polling')
+    pool = None
+    if jobs > 1 and multiprocessing is not None:
+        pool = multiprocessing.Pool(jobs)
+    start = time.time()
+    metrics = {'files': 0, 'skipped': 0, 'bytes_in': 0, 'bytes_out': 0}
+    levels = set()
+    try:
+        while 1:
+            newfiles = []
+            if srcfiles:
+                newest = max(srcfiles)
+                newfiles = sorted(f for f in srcfiles
+                                  if f < newest and f not in manifest)
+            tasks, reserved = [], 0
+            pending = len(newfiles)
+            for n, newfile in enumerate(newfiles):
+                oldest = manifest.oldest()
+                if oldest is not None and oldest >= newfile:
+                    metrics['skipped'] += 1
+                    srcfiles.discard(newfile)
+                    pending -= 1
+                    continue
+                srcfile = os.path.join(srcdir, newfile)
+                try:
+                    size = os.path.getsize(srcfile)
+                except OSError:
+                    srcfiles.discard(newfile)
+                    pending -= 1
+                    continue
+                if not make_room(dstdir, manifest, reserved + size, budget,
+                                 debug):
+                    break
+                pending -= 1
+                level = compress_level(len(newfiles) - n, cpu_load(), ratio,
+                                       maxbacklog)
+                if gzip:
+                    levels.add(level)
+                tasks.append((srcfile, dstdir, gzip, level))
+                reserved += size
+                if len(tasks) >= jobs:
+                    backup_tasks(pool, tasks, dstdir, manifest, metrics, debug)
+                    tasks, reserved = [], 0
+            if tasks:
+                backup_tasks(pool, tasks, dstdir, manifest, metrics, debug)
+            if time.time() - start >= interval:
+                secs = time.time() - start
+                metrics.update({'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                    'backlog': pending, 'secs': secs,
+                    'rate': metrics['bytes_in'] / 1048576.0 / secs,
+                    'levels': ','.join(str(x) for x in sorted(levels)) or '-',
+                    'load': cpu_load()})
+                write_metrics(dstdir, metrics, metrics_file, debug)
+                manifest.compact()
+                budget = space_budget(dstdir, manifest, maxuse, debug)
+                start = time.time()
+                metrics = {'files': 0, 'skipped': 0, 'bytes_in': 0,
+                           'bytes_out': 0}
+                levels = set()
+            if inotify is not None:
+                for mask, name in inotify.read(poll * 12):
+                    if not fnmatch.fnmatch(name, files):
+                        continue
+                    if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                        srcfiles.add(name)
+                    else:
+                        srcfiles.discard(name)
+            else:
+                time.sleep(poll)
+                srcfiles = set(fnmatch.filter(os.listdir(srcdir), files))
+    finally:
+        if pool is not None:
+            pool.terminate()
+        lock.close()
+
+CHUNK_MIN = 16 * 1024
+CHUNK_MAX = 256 * 1024
+CHUNK_MASK = 511
+
+def iterchunks(fd, minsize=CHUNK_MIN, maxsize=CHUNK_MAX, mask=CHUNK_MASK):
+    buf, size = [], 0
+    while 1:
+        line = fd.readline(maxsize)
+        if not line:
+            break
+        buf.append(line)
+        size += len(line)
+        if size >= maxsize or (size >= minsize and
+                               zlib.crc32(line) & mask == 0):
+            yield ''.join(buf)
+            buf, size = [], 0
+    if buf:
+        yield ''.join(buf)
+
+def chunk_path(dstdir, digest):
+    return os.path.join(dstdir, 'chunks', digest[:2], digest)
+
+def store_chunk(dstdir, data, compresslevel=4):
+    digest = sha1(data).hexdigest()
+    path = chunk_path(dstdir, digest)
+    if os.path.exists(path):
+        return digest, 0
+    folder = os.path.dirname(path)
+    if not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+    tmpfile = '%s.%d.tmp' % (path, os.getpid())
+    fd = open(tmpfile, 'wb')
+    try:
+        fd.write(zlib.compress(data, compresslevel))
+    finally:
+        fd.close()
+    os.rename(tmpfile, path)
+    return digest, os.path.getsize(path)
+
+def manifest_path(dstdir, label, filename):
+    return os.path.join(dstdir, 'manifests', label, filename)
+
+def read_chunk_manifest(path):
+    fd = open(path)
+    try:
+        header = fd.readline().split()
+        chunks = []
+        for line in fd:
+            digest, length = line.split()
+            chunks.append((digest, int(length)))
+    finally:
+        fd.close()
+    return header, chunks
+
+def dedup_file(task):
+    srcfile, dstdir, label, compresslevel, name = task
+    st = os.stat(srcfile)
+    path = manifest_path(dstdir, label, name)
+    if os.path.exists(path):
+        header = read_chunk_manifest(path)[0]
+        if header[:2] == [str(st.st_size), str(int(st.st_mtime))]:
+            return 0, 0
+    whole = sha1()
+    chunks, size_in, size_out = [], 0, 0
+    fd = open(srcfile, 'rb')
+    try:
+        for data in iterchunks(fd):
+            digest, stored = store_chunk(dstdir, data, compresslevel)
+            whole.update(data)
+            chunks.append('%s %d\n' % (digest, len(data)))
+            size_in += len(data)
+            size_out += stored
+    finally:
+        fd.close()
+    folder = os.path.dirname(path)
+    if not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+    tmpfile = '%s.%d.tmp' % (path, os.getpid())
+    fd = open(tmpfile, 'w')
+    try:
+        fd.write('%d %d %s\n' % (size_in, int(st.st_mtime), whole.hexdigest()))
+        fd.writelines(chunks)
+    finally:
+        fd.close()
+    os.rename(tmpfile, path)
+    return size_in, size_out
+
+def restore_file(dstdir, label, filename, outfile):
+    header, chunks = read_chunk_manifest(manifest_path(dstdir, label, filename))
+    whole = sha1()
+    tmpfile = outfile + '.tmp'
+    fd = open(tmpfile, 'wb')
+    try:
+        for digest, length in chunks:
+            chunk_fd = open(chunk_path(dstdir, digest), 'rb')
+            try:
+                data = zlib.decompress(chunk_fd.read())
+            finally:
+                chunk_fd.close()
+            if len(data) != length:
+                raise IOError('Chunk %s of %s is corrupted!' % (digest,
+                                                                filename))
+            whole.update(data)
+            fd.write(data)
+    finally:
+        fd.close()
+    if whole.hexdigest() != header[2]:
+        os.remove(tmpfile)
+        raise IOError('Restored %s does not match the original!' % filename)
+    os.rename(tmpfile, outfile)
+    os.utime(outfile, (int(header[1]), int(header[1])))
+
+def collect_garbage(dstdir, debug=0):
+    referenced = set()
+    for root, dirs, filenames in os.walk(os.path.join(dstdir, 'manifests')):
+        for filename in filenames:
+            if filename.endswith('.tmp'):
+                continue
+            path = os.path.join(root, filename)
+            for digest, length in read_chunk_manifest(path)[1]:
+                referenced.add(digest)
+    removed = 0
+    for path in glob.glob(os.path.join(dstdir, 'chunks', '*', '*')):
+        if os.path.basename(path) not in referenced:
+            os.remove(path)
+            removed += 1
+    if debug:
+        print 'collect_garbage: removed %s chunks' % removed
+
+def run_dedups(pool, tasks, metrics, debug=0):
+    if pool is not None:
+        results = pool.map(dedup_file, tasks)
+    else:
+        results = map(dedup_file, tasks)
+    for task, (size_in, size_out) in zip(tasks, results):
+        metrics['files'] += 1
+        metrics['bytes_in'] += size_in
+        metrics['bytes_out'] += size_out
+        if debug:
+            print 'dedup: stored %s, %s new bytes' % (task[0], size_out)
+
+def sweep_dedup(srcdir, dstdir, files, maxuse=90, ratio=4, debug=0, jobs=2,
+                maxbacklog=10, metrics_file=None, label='ecs', evict=10):
+    start = time.time()
+    srcfiles = glob_files(srcdir, files)[:-1]
+    folder = os.path.join(dstdir, 'manifests', label)
+    stored = []
+    if os.path.isdir(folder):
+        stored = sorted(x for x in fnmatch.filter(os.listdir(folder), files)
+                        if not x.endswith('.tmp'))
+    newfiles = sorted(set(srcfiles).difference(set(stored)))
+    if debug:
+        print 'sweep_dedup: newfiles 0:%s, -1:%s' % (newfiles[:1],
+                                                     newfiles[-1:])
+    load = cpu_load()
+    metrics = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'files': 0,
+               'backlog': len(newfiles), 'skipped': 0, 'bytes_in': 0,
+               'bytes_out': 0, 'load': load}
+    levels = set()
+    pool = None
+    if jobs > 1 and len(newfiles) > 1 and multiprocessing is not None:
+        pool = multiprocessing.Pool(min(jobs, len(newfiles)))
+    tasks = []
+    try:
+        for n, newfile in enumerate(newfiles):
+            if stored and stored[0] >= newfile:
+                metrics['skipped'] += 1
+                continue
+            full = False
+            while disk_usage(dstdir)['percent'] >= maxuse:
+                if not stored:
+                    full = True
+                    break
+                for oldest in stored[:evict]:
+                    os.remove(os.path.join(folder, oldest))
+                    if debug:
+                        print 'sweep_dedup: removed %s' % oldest
+                del stored[:evict]
+                collect_garbage(dstdir, debug)
+            if full:
+                break
+            level = compress_level(len(newfiles) - n, load, ratio, maxbacklog)
+            levels.add(level)
+            tasks.append((os.path.join(srcdir, newfile), dstdir, label, level,
+                          newfile))
+            if len(tasks) >= jobs:
+                run_dedups(pool, tasks, metrics, debug)
+                tasks = []
+        if tasks:
+            run_dedups(pool, tasks, metrics, debug)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    metrics['secs'] = time.time() - start
+    metrics['rate'] = metrics['bytes_in'] / 1048576.0 / max(metrics['secs'],
+                                                            0.001)
+    metrics['levels'] = ','.join(str(x) for x in sorted(levels)) or '-'
+    metrics['backlog'] -= metrics['files'] + metrics['skipped']
+    write_metrics(dstdir, metrics, metrics_file, debug)
+
+def store_paths(dstdir, label, paths, ratio=4, jobs=2, debug=0):
+    tasks = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, filenames in os.walk(path):
+                for filename in filenames:
+                    srcfile = os.path.join(root, filename)
+                    name = srcfile[len(path):].lstrip(os.sep)
+                    tasks.append((srcfile, dstdir, label, ratio, name))
         else:
-            shutil.copy2(srcfile, dstdir)
-            if debug:
-                print 'sweep: copied %s' % srcfile
+            tasks.append((path, dstdir, label, ratio, os.path.basename(path)))
+    tasks.sort()
+    metrics = {'files': 0, 'bytes_in': 0, 'bytes_out': 0}
+    pool = None
+    if jobs > 1 and len(tasks) > 1 and multiprocessing is not None:
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+    try:
+        run_dedups(pool, tasks, metrics, debug)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    print 'Stored %d files, %d bytes read, %d new bytes written' % (
+          metrics['files'], metrics['bytes_in'], metrics['bytes_out'])
 
 def main():
+    if len(sys.argv) > 3 and sys.argv[1] == 'store':
+        if not os.path.isdir(sys.argv[2]):
+            os.makedirs(sys.argv[2])
+        return store_paths(sys.argv[2], sys.argv[3], sys.argv[4:], RATIO,
+                           JOBS, DEBUG)
+    if len(sys.argv) in (5, 6) and sys.argv[1] == 'restore':
+        outfile = sys.argv[-1]
+        if len(sys.argv) == 5:
+            outfile = os.path.basename(sys.argv[4])
+        return restore_file(sys.argv[2], sys.argv[3], sys.argv[4], outfile)
     if len(sys.argv) > 1:
-        print HELP % (SRCDIR, DSTDIR, FILES, MAXUSE, GZIP, RATIO, DEBUG)
+        print HELP % (SRCDIR, DSTDIR, FILES, MAXUSE, GZIP, RATIO, JOBS,
+                      BACKLOG, METRICS, DAEMON, BUNDLE, DEDUP, DEBUG,
+                      sys.argv[0], sys.argv[0])
         return 1
     prerun_checks(SRCDIR, DSTDIR, DEBUG)
-    sweep(SRCDIR, DSTDIR, FILES, MAXUSE, GZIP, RATIO, DEBUG)
+    if DAEMON:
+        return daemon(SRCDIR, DSTDIR, FILES, MAXUSE, GZIP, RATIO, DEBUG, JOBS,
+                      BACKLOG, METRICS)
+    if DEDUP:
+        return sweep_dedup(SRCDIR, DSTDIR, FILES, MAXUSE, RATIO, DEBUG, JOBS,
+                           BACKLOG, METRICS)
+    if BUNDLE:
+        return sweep_bundles(SRCDIR, DSTDIR, FILES, MAXUSE, RATIO, DEBUG, JOBS,
+                             BACKLOG, METRICS)
+    sweep(SRCDIR, DSTDIR, FILES, MAXUSE, GZIP, RATIO, DEBUG, JOBS, BACKLOG,
+          METRICS)
 
 if __name__ == '__main__':
     sys.exit(main())
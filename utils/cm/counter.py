@@ -12,6 +12,7 @@
 #############################################################################
 '''
 import fileinput
+import math
 import os
 try:
     os.nice(19)
@@ -20,12 +21,22 @@ except:
 import re
 import sys
 import time
+from array import array
+from bisect import bisect_left
 from copy import deepcopy
 from glob import glob
-from heapq import nlargest
+from heapq import heapify, heappop, heappush, nlargest
 from operator import itemgetter
 from optparse import Option, OptionGroup, OptionParser, OptionValueError
 from optparse import SUPPRESS_HELP
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 try:
     from collections import Counter
 except ImportError:
@@ -217,6 +228,143 @@ class LimitedSizeDict(OrderedDict):
       while len(self) > self.size:
         self.popitem(last=False)
 
+class HeavyHitters(object):
+    '''
+    Approximate Counter of the most frequent items in bounded memory for
+    --top. A Count-Min sketch of depth 5 and width e/error sits in front of a
+    Space-Saving summary monitoring the 1/error most frequent items. Counts
+    are never less than the true counts and are more by at most error times
+    the number of items counted, the overcount of each monitored item is
+    bounded by the number of its occurrences seen since it became monitored.
+    '''
+    DEPTH = 5
+
+    def __init__(self, top=10, error=0.001):
+        self.top = top
+        self.error = error
+        self.width = int(math.ceil(math.e / error))
+        self.capacity = max(top, int(math.ceil(1 / error)))
+        self.sketch = array("l", [0]) * (self.width * self.DEPTH)
+        self.monitored = {}
+        self.heap = []
+        self.total = 0
+
+    def _cells(self, item):
+        h = hash(item)
+        step = (h >> 16) | 1
+        width = self.width
+        return [row * width + (h + row * step) % width
+                for row in xrange(self.DEPTH)]
+
+    def _evict(self):
+        '''Drops the least counted monitored item and returns its count.'''
+        while 1:
+            upper, item = heappop(self.heap)
+            entry = self.monitored[item]
+            if entry[0] == upper:
+                del self.monitored[item]
+                return upper
+            heappush(self.heap, (entry[0], item))
+
+    def add(self, item, n=1):
+        sketch = self.sketch
+        estimate = None
+        for cell in self._cells(item):
+            sketch[cell] += n
+            if estimate is None or sketch[cell] < estimate:
+                estimate = sketch[cell]
+        self.total += n
+        entry = self.monitored.get(item)
+        if entry is not None:
+            entry[0] += n
+            entry[1] += n
+        elif len(self.monitored) < self.capacity:
+            self.monitored[item] = [n, n]
+            heappush(self.heap, (n, item))
+        else:
+            upper = min(self._evict() + n, estimate)
+            self.monitored[item] = [upper, n]
+            heappush(self.heap, (upper, item))
+
+    def merge(self, other):
+        '''Adds the counts of other HeavyHitters of the same parameters.'''
+        sketch = self.sketch
+        for cell, n in enumerate(other.sketch):
+            if n:
+                sketch[cell] += n
+        floors = []
+        for summary in (self, other):
+            if len(summary.monitored) >= summary.capacity:
+                floors.append(min([e[0] for e in summary.monitored.values()]))
+            else:
+                floors.append(0)
+        merged = {}
+        for item in set(self.monitored) | set(other.monitored):
+            upper, lower = 0, 0
+            for summary, floor in zip((self, other), floors):
+                entry = summary.monitored.get(item)
+                if entry is None:
+                    upper += floor
+                else:
+                    upper += entry[0]
+                    lower += entry[1]
+            merged[item] = [upper, lower]
+        if len(merged) > self.capacity:
+            kept = nlargest(self.capacity,
+                            [(e[0], item) for item, e in merged.iteritems()])
+            merged = dict((item, merged[item]) for upper, item in kept)
+        self.monitored = merged
+        self.heap = [(e[0], item) for item, e in merged.iteritems()]
+        heapify(self.heap)
+        self.total += other.total
+
+    def update(self, iterable):
+        if isinstance(iterable, HeavyHitters):
+            self.merge(iterable)
+        elif isinstance(iterable, dict):
+            for item, n in iterable.iteritems():
+                self.add(item, n)
+        else:
+            for item in iterable:
+                self.add(item)
+
+    def bounds(self, item):
+        '''Returns the lowest and highest possible count of item.'''
+        entry = self.monitored.get(item)
+        if entry is None:
+            return 0, 0
+        sketch = self.sketch
+        estimate = min([sketch[cell] for cell in self._cells(item)])
+        return entry[1], min(entry[0], estimate)
+
+    def __getitem__(self, item):
+        return self.bounds(item)[1]
+
+    def most_common(self, n=None):
+        if n is None:
+            n = self.top
+        counts = [(item, self[item]) for item in self.monitored]
+        counts.sort(key=lambda x: (-x[1], x[0]))
+        return counts[:n]
+
+    def __iter__(self):
+        for item, count in self.most_common():
+            yield item
+
+    def overcount(self):
+        '''Returns the largest possible overcount of the top items.'''
+        bounds = [self.bounds(item) for item in self]
+        return max([0] + [upper - lower for lower, upper in bounds])
+
+class HeavyHittersFactory(object):
+    '''Returns new HeavyHitters of the same parameters, picklable for -j.'''
+    def __init__(self, top, error):
+        self.top = top
+        self.error = error
+
+    def __call__(self):
+        return HeavyHitters(self.top, self.error)
+
 
 class MultipleOption(Option):
     ACTIONS = Option.ACTIONS + ("extend",)
@@ -274,11 +422,20 @@ TIMESTAMP_POSITIONS = {
     'DAY' : (0, 8),
     }
 DEFAULT_TIMEPOS = TIMESTAMP_POSITIONS["HOUR"]
+ECS_LOGDIR = "/var/log/ecs"
+REDRAW_INTERVAL = 1
+RE_ECS_LOGNAME = re.compile(r"(\d{4})-(\d{4})-(\d{6})")
 DEFAULT_PATTERN = PATTERNS["denial"]
+STORE_PATTERNS = OrderedDict(item for name in ("alarm", "error", "denial",
+                              "proc_err") for item in PATTERNS[name].items())
 VERSION = 0.1
 
 
-def pprint_intervals(i, name="", ordered=True, column_gap=2, print_zero=False):
+def interval_cells(i, name="", ordered=True, column_gap=2, print_zero=False):
+    '''
+    Returns the width of the left pane, the width of the columns and the
+    rows of cells of the table of the intervals in i, the header row first.
+    '''
     col_names = i.keys()
     if ordered:
         col_names.sort()
@@ -291,9 +448,7 @@ def pprint_intervals(i, name="", ordered=True, column_gap=2, print_zero=False):
     cell_width = max(len(str(i[k][c])) for k,v in i.iteritems() for c in v)
     left_pane_width = max(name_width, row_name_width)
     col_width = max(col_name_width, cell_width)
-    output = []
-    output.append(''.join((name.ljust(left_pane_width),
-                           ''.join(x.rjust(col_width) for x in col_names))))
+    rows = [[name] + col_names]
     for row_name in row_names:
         cells = [str(i[col_name][row_name]) for col_name in col_names]
         if not print_zero:
@@ -306,19 +461,512 @@ def pprint_intervals(i, name="", ordered=True, column_gap=2, print_zero=False):
                 else:
                     c.append(" ")
             cells = c
-        output.append(''.join((row_name.ljust(left_pane_width),
-                               ''.join(x.rjust(col_width) for x in cells))))
+        rows.append([row_name] + cells)
+    return left_pane_width, col_width, rows
+
+def pprint_intervals(i, name="", ordered=True, column_gap=2, print_zero=False,
+                     footer=None):
+    left_pane_width, col_width, rows = interval_cells(i, name, ordered,
+                                                      column_gap, print_zero)
+    if footer:
+        row_name, values = footer
+        cells = [str(values[col_name]) for col_name in rows[0][1:]]
+        rows.append([row_name] + cells)
+        left_pane_width = max(left_pane_width, len(row_name) + column_gap)
+        col_width = max([col_width] + [len(x) + column_gap for x in cells])
+    output = []
+    for row in rows:
+        output.append(''.join((row[0].ljust(left_pane_width),
+                               ''.join(x.rjust(col_width) for x in row[1:]))))
     return "\n".join(output)
 
-def iterevents(patterns, logfiles, timepos=(0,11)):
+class LiveScreen(object):
+    '''
+    Draws the interval tables on an ANSI terminal and keeps the frame drawn
+    last. A redraw writes only the cells which differ from the last frame,
+    a line is rewritten as a whole only if its layout has changed.
+    '''
+    def __init__(self, out=sys.stdout):
+        self.out = out
+        self.frame = None
+
+    @staticmethod
+    def layout(tables):
+        '''Returns the frame of tables as lines of (column, text) cells.'''
+        frame = []
+        for left_pane_width, col_width, rows in tables:
+            for row in rows:
+                line = [(0, row[0].ljust(left_pane_width))]
+                col = left_pane_width
+                for cell in row[1:]:
+                    line.append((col, cell.rjust(col_width)))
+                    col += col_width
+                frame.append(line)
+            frame.append([])
+        return frame
+
+    def draw(self, tables):
+        frame = self.layout(tables)
+        out = []
+        if self.frame is None:
+            out.append("\033[H\033[2J")
+            prev = []
+        else:
+            prev = self.frame
+        for n, line in enumerate(frame):
+            if n < len(prev) and [c for c, _ in prev[n]] == [c for c, _ in line]:
+                for (col, text), (_, prev_text) in zip(line, prev[n]):
+                    if text != prev_text:
+                        out.append("\033[%d;%dH%s" % (n + 1, col + 1, text))
+            else:
+                out.append("\033[%d;1H%s\033[K" % (n + 1,
+                           "".join(text for _, text in line)))
+        if len(frame) < len(prev):
+            out.append("\033[%d;1H\033[J" % (len(frame) + 1))
+        out.append("\033[%d;1H" % (len(frame) + 1))
+        self.out.write("".join(out))
+        self.out.flush()
+        self.frame = frame
+
+class EventMatcher(object):
+    '''
+    Matches an input line against all the event patterns in one go. The
+    event of a line is the first event, in the order of the patterns, whose
+    keyword is in the line, and the line is counted only if the precompiled
+    regex of that event matches the line as well. With a few keywords these
+    are looked for one after the other, with more than MAX_SCAN_KEYWORDS a
+    single alternation of all the keywords is searched for instead.
+    '''
+    MAX_SCAN_KEYWORDS = 10
+
+    def __init__(self, patterns):
+        self.keywords = list(patterns)
+        self.regexes = dict((k, re.compile(v)) for k, v in patterns.items())
+        self.priority = dict((k, i) for i, k in enumerate(self.keywords))
+        if len(self.keywords) > self.MAX_SCAN_KEYWORDS:
+            keywords = sorted(self.keywords, key=len, reverse=True)
+            self.reKeywords = re.compile("|".join(re.escape(k) for k in
+                                                  keywords))
+        else:
+            self.reKeywords = None
+
+    def event(self, line):
+        '''Returns the event keyword of line or None.'''
+        if self.reKeywords is None:
+            for keyword in self.keywords:
+                if keyword in line:
+                    return keyword
+            return None
+        m = self.reKeywords.search(line)
+        if not m:
+            return None
+        keyword = m.group()
+        #a keyword of a preceding pattern may be further in the line
+        for k in self.keywords[:self.priority[keyword]]:
+            if k in line:
+                return k
+        return keyword
+
+    def match(self, line):
+        '''Returns the event keyword and regex groups of line or None.'''
+        event = self.event(line)
+        if event is None:
+            return None
+        m = self.regexes[event].search(line)
+        if not m:
+            return None
+        return event, m.groups()
+
+
+def itermatches(lines, patterns, timepos=(0,11)):
     timepos_slice = slice(*timepos)
-    for line in fileinput.input(logfiles, bufsize=2048*2048):
-        events = [pattern for pattern in patterns if pattern in line]
-        if events:
-            m = re.search(patterns[events[0]], line)
-            if not m:
+    match = EventMatcher(patterns).match
+    for line in lines:
+        m = match(line)
+        if m:
+            yield line[timepos_slice], m[0], m[1]
+
+def iterevents(patterns, logfiles, timepos=(0,11)):
+    return itermatches(fileinput.input(logfiles, bufsize=2048*2048),
+                       patterns, timepos)
+
+class RangeIndex(object):
+    '''
+    Sorted index of the custom time ranges. The boundaries of the ranges of
+    the same length are merged into one sorted list and the first range
+    covering each boundary, and each gap between two boundaries, is worked
+    out in advance, so a lookup is a bisect instead of a scan of the ranges.
+    '''
+    def __init__(self, ranges):
+        self.ranges = ranges
+        self.labels = ['-'.join(r) for r in ranges]
+        self.groups = []
+        for length in sorted(set([len(s) for s, e in ranges])):
+            members = [n for n, (s, e) in enumerate(ranges) if len(s) == length]
+            bounds = set()
+            for n in members:
+                bounds.update(ranges[n])
+            bounds = sorted(bounds)
+            firsts = []
+            for j, bound in enumerate(bounds):
+                gap, point = None, None
+                for n in members:
+                    s, e = ranges[n]
+                    if gap is None and j and s <= bounds[j-1] and bound <= e:
+                        gap = n
+                    if point is None and s <= bound <= e:
+                        point = n
+                firsts.extend((gap, point))
+            firsts.append(None)
+            self.groups.append((length, bounds, firsts))
+
+    def lookup(self, ts):
+        '''Returns the first range ts falls in as "start-end" or None.'''
+        first = None
+        for length, bounds, firsts in self.groups:
+            t = ts[0:length]
+            i = bisect_left(bounds, t)
+            if i < len(bounds) and bounds[i] == t:
+                n = firsts[2*i+1]
+            else:
+                n = firsts[2*i]
+            if n is not None and (first is None or n < first):
+                first = n
+        if first is None:
+            return None
+        return self.labels[first]
+
+    def overlaps(self, start, end=None):
+        '''
+        Returns True if any of the ranges may match a timestamp between start
+        and end, an end of None being open.
+        '''
+        for s, e in self.ranges:
+            if e >= start[0:len(s)] and (end is None or s <= end[0:len(s)]):
+                return True
+        return False
+
+def select_logfiles(logfiles, custom_ranges):
+    '''
+    Drops the ecs log files which by the times in their names can not hold
+    any event in the custom ranges. A log file is taken to span from the time
+    in its name to that of the next log file of the same directory, files
+    of other names are always kept.
+    :param logfiles: sorted list of log file names
+    :param custom_ranges: RangeIndex
+    :return: list of the log files to read
+    '''
+    starts = {}
+    for logfile in logfiles:
+        m = RE_ECS_LOGNAME.match(os.path.basename(logfile))
+        if m:
+            starts.setdefault(os.path.dirname(logfile), []).append(
+                ("%s%s:%s" % m.groups(), logfile))
+    spans = {}
+    for dirstarts in starts.values():
+        dirstarts.sort()
+        for n, (start, logfile) in enumerate(dirstarts):
+            if n + 1 < len(dirstarts):
+                spans[logfile] = (start, dirstarts[n+1][0] + "999")
+            else:
+                spans[logfile] = (start, None)
+    selected = []
+    for logfile in logfiles:
+        if logfile not in spans or custom_ranges.overlaps(*spans[logfile]):
+            selected.append(logfile)
+    return selected
+
+class EventStore(object):
+    '''
+    Append-only store of the events of the ecs logs matched by the builtin
+    patterns, partitioned by the hour. Each ingest appends a batch to the
+    partition files, holding the millisecond timestamps and keys of the
+    events, the postings lists of the rows of each event type and of each
+    qualifier and the counts of the keys per minute, so that queries by the
+    minute or coarser do not have to visit the rows at all.
+    '''
+    MANIFEST = "manifest"
+    SUFFIX = ".evt"
+    RE_TS = re.compile(r"\d{8}:\d{9}$")
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.manifest = {}
+        manifest = os.path.join(path, self.MANIFEST)
+        if os.path.isfile(manifest):
+            fd = open(manifest, "rb")
+            try:
+                self.manifest = pickle.load(fd)
+            finally:
+                fd.close()
+
+    def _save_manifest(self):
+        path = os.path.join(self.path, self.MANIFEST)
+        tmp = path + ".tmp"
+        fd = open(tmp, "wb")
+        try:
+            pickle.dump(self.manifest, fd, 2)
+        finally:
+            fd.close()
+        os.rename(tmp, path)
+
+    def _readlines(self, logfile):
+        '''
+        Generates the complete lines of logfile not ingested yet. The offset
+        of the line generated is kept in the manifest, so that a manifest
+        saved while the line is processed resumes from that line, and the
+        offset following the last of them once they are all generated.
+        '''
+        name = os.path.realpath(logfile)
+        offset = self.manifest.get(name, 0)
+        if os.path.getsize(logfile) < offset:
+            print >>sys.stderr, "Skipped, shorter than when ingested:", logfile
+            return
+        fd = open(logfile, "rb")
+        try:
+            fd.seek(offset)
+            for line in fd:
+                if not line.endswith("\n"):
+                    break
+                self.manifest[name] = offset
+                offset += len(line)
+                yield line
+        finally:
+            fd.close()
+        self.manifest[name] = offset
+
+    def _write_batch(self, hour, batch):
+        '''Appends the batch of events of the hour to its partition.'''
+        state = {
+            "keys": batch["keys"],
+            "ms": batch["ms"].tostring(),
+            "rows": batch["rows"].tostring(),
+            "events": dict((k, v.tostring()) for k, v in
+                           batch["events"].iteritems()),
+            "qualifiers": dict((k, v.tostring()) for k, v in
+                               batch["qualifiers"].iteritems()),
+            "minutes": batch["minutes"],
+        }
+        name = hour.replace(":", "-") + self.SUFFIX
+        fd = open(os.path.join(self.path, name), "ab")
+        try:
+            pickle.dump(state, fd, 2)
+        finally:
+            fd.close()
+
+    def ingest(self, logfiles):
+        '''
+        Appends the events of the logfiles not yet in the store. The events
+        are written a batch per hour as soon as the logfile moves on to the
+        next hour, so only the events of one hour are held in memory, and
+        the manifest is saved after each batch, so that an interrupted
+        ingest does not append the events of the written batches again.
+        :return: the number of events appended
+        '''
+        hour, batch = None, None
+        count = 0
+        for logfile in logfiles:
+            lines = self._readlines(logfile)
+            for ts, event, qualifiers in itermatches(lines, STORE_PATTERNS,
+                                                     (0, 18)):
+                if not self.RE_TS.match(ts):
+                    continue
+                if ts[0:11] != hour:
+                    if batch is not None:
+                        self._write_batch(hour, batch)
+                        self._save_manifest()
+                    hour = ts[0:11]
+                    batch = {"keys": [], "key_ids": {},
+                        "ms": array("I"), "rows": array("I"), "events": {},
+                        "qualifiers": {}, "minutes": [], "minute_ids": {}}
+                key = (event, tuple(qualifiers))
+                key_id = batch["key_ids"].get(key)
+                if key_id is None:
+                    key_id = batch["key_ids"][key] = len(batch["keys"])
+                    batch["keys"].append(key)
+                row = len(batch["rows"])
+                batch["rows"].append(key_id)
+                minute = int(ts[11:13])
+                batch["ms"].append(minute * 60000 + int(ts[13:18]))
+                batch["events"].setdefault(event, array("I")).append(row)
+                for qualifier in key[1]:
+                    batch["qualifiers"].setdefault(qualifier, array("I")
+                                                   ).append(row)
+                pos = batch["minute_ids"].get((minute, key_id))
+                if pos is None:
+                    batch["minute_ids"][(minute, key_id)] = len(
+                                                        batch["minutes"])
+                    batch["minutes"].append([minute, key_id, 1])
+                else:
+                    batch["minutes"][pos][2] += 1
+                count += 1
+        if batch is not None:
+            self._write_batch(hour, batch)
+        self._save_manifest()
+        return count
+
+    def iterbatches(self, custom_ranges=None):
+        '''
+        Generates the hour and the batches of the partitions in time order,
+        the partitions outside of the custom_ranges are not read.
+        '''
+        for name in sorted(glob(os.path.join(self.path, "*" + self.SUFFIX))):
+            hour = os.path.basename(name)[0:11].replace("-", ":")
+            if custom_ranges and not custom_ranges.overlaps(hour,
+                                                            hour + "9999999"):
                 continue
-            yield line[timepos_slice], events[0], m.groups()
+            fd = open(name, "rb")
+            try:
+                while 1:
+                    try:
+                        yield hour, pickle.load(fd)
+                    except EOFError:
+                        break
+            finally:
+                fd.close()
+
+    @staticmethod
+    def _postings(postings, term):
+        rows = array("I")
+        if term in postings:
+            rows.fromstring(postings[term])
+        return rows
+
+    def events(self, events, where=(), custom_ranges=None, minutes=False):
+        '''
+        Generates the (ts, event, qualifiers, count) of the events of the
+        given event types which have all the qualifiers in where. If minutes
+        is True ts is of minute precision and count is that of the minute,
+        otherwise ts is of millisecond precision and count is 1.
+        '''
+        events = set(events)
+        where = set(where)
+        for hour, batch in self.iterbatches(custom_ranges):
+            keys = batch["keys"]
+            if minutes:
+                for minute, key_id, n in batch["minutes"]:
+                    event, qualifiers = keys[key_id]
+                    if event in events and where.issubset(qualifiers):
+                        yield "%s%02d" % (hour, minute), event, qualifiers, n
+                continue
+            selected = set()
+            for event in events:
+                selected.update(self._postings(batch["events"], event))
+            for qualifier in where:
+                selected.intersection_update(
+                    self._postings(batch["qualifiers"], qualifier))
+            ms = array("I")
+            ms.fromstring(batch["ms"])
+            rows = array("I")
+            rows.fromstring(batch["rows"])
+            for row in sorted(selected):
+                event, qualifiers = keys[rows[row]]
+                m = ms[row]
+                ts = "%s%02d%02d%03d" % (hour, m // 60000, m // 1000 % 60,
+                                         m % 1000)
+                yield ts, event, qualifiers, 1
+
+def count_runs(events, custom_ranges=None, verbosity=1, counter=Counter):
+    '''
+    Counts the qualifiers of the events per event and interval. The counts
+    are kept in runs of consecutive events of the same interval in the order
+    they were seen, so replaying them with merge_runs() gives the same table
+    as counting the events one by one into the LimitedSizeDict.
+    :param events: iterable of (ts, event, qualifiers) as from iterevents
+    :param counter: factory of the Counter of each run
+    :return: OrderedDict of event: list of [interval, Counter]
+    '''
+    runs = OrderedDict()
+    for ts, event, qualifiers in events:
+        if custom_ranges:
+            ts = custom_ranges.lookup(ts)
+            if ts is None:
+                continue
+        event_runs = runs.setdefault(event, [])
+        if not event_runs or event_runs[-1][0] != ts:
+            event_runs.append([ts, counter()])
+        event_runs[-1][1].update([' '.join(qualifiers[:verbosity])])
+    return runs
+
+def merge_runs(intervals, runs, buffsize):
+    '''Replays the runs of count_runs() into the intervals tables.'''
+    for event, event_runs in runs.iteritems():
+        table = intervals.setdefault(event, LimitedSizeDict(size=buffsize))
+        for ts, counter in event_runs:
+            if ts in table:
+                table[ts].update(counter)
+            else:
+                table[ts] = counter
+
+def count_logfile(task):
+    '''Worker of --jobs, returns the count_runs() of a single logfile.'''
+    logfile, patterns, timepos, custom_ranges, verbosity, counter = task
+    fd = open(logfile)
+    try:
+        events = itermatches(fd, patterns, timepos)
+        return count_runs(events, custom_ranges, verbosity, counter)
+    finally:
+        fd.close()
+
+def count_parallel(args):
+    '''
+    Counts the logfiles in args["jobs"] worker processes, one logfile at a
+    time, and merges the results in the order of the logfiles.
+    :return: OrderedDict of event: LimitedSizeDict of interval: Counter
+    '''
+    intervals = OrderedDict()
+    tasks = [(logfile, args["patterns"], args["timepos"],
+              args["custom_ranges"], args["verbosity"], args["counter"])
+             for logfile in args["logfiles"]]
+    pool = multiprocessing.Pool(args["jobs"])
+    try:
+        for runs in pool.imap(count_logfile, tasks):
+            merge_runs(intervals, runs, args["buffsize"])
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    pool.join()
+    return intervals
+
+def benchmark(patterns, logfiles, sizes=(4, 50), maxlines=1000000):
+    '''
+    Prints the time it takes to match the lines of logfiles with the
+    per pattern substring search and with EventMatcher. The patterns are
+    padded with never matching ones to each number of patterns in sizes.
+    '''
+    lines = []
+    for line in fileinput.input(logfiles, bufsize=2048*2048):
+        lines.append(line)
+        if len(lines) >= maxlines:
+            break
+    fileinput.close()
+    print "Lines: %d" % len(lines)
+    for size in sizes:
+        padded = OrderedDict(patterns)
+        i = 0
+        while len(padded) < size:
+            padded["NOSUCHEVT%02d" % i] = "(\S+)"
+            i += 1
+        start = time.time()
+        legacy = 0
+        for line in lines:
+            events = [pattern for pattern in padded if pattern in line]
+            if events:
+                if re.search(padded[events[0]], line):
+                    legacy += 1
+        legacy_time = time.time() - start
+        match = EventMatcher(padded).match
+        start = time.time()
+        matched = 0
+        for line in lines:
+            if match(line):
+                matched += 1
+        matcher_time = time.time() - start
+        print "Patterns: %3d  substring: %.3fs  EventMatcher: %.3fs  (%d/%d)" % (
+            len(padded), legacy_time, matcher_time, legacy, matched)
 
 def parse_ranges(ranges):
     l = []
@@ -391,12 +1039,69 @@ def parse_args(args):
         metavar=" ",
         help="add one or more to print one or more groups of the regular\
  expression groups defined by -p")
+    parser.add_option("-f", "--follow",
+        action="store_true",
+        default=False,
+        dest="follow",
+        help="follow the ecs log file being written, also across\
+ rotations, and redraw the tables whenever a new interval starts. The log\
+ directory is /var/log/ecs or that of the last log file argument")
+    parser.add_option("-j", "--jobs",
+        action="store",
+        default=1,
+        dest="jobs",
+        metavar="<number>",
+        type="int",
+        help="number of worker processes counting the log files in\
+ parallel, the default is 1")
+    parser.add_option("--top",
+        action="store",
+        default=0,
+        dest="top",
+        metavar="<number>",
+        type="int",
+        help="approximate mode, count in bounded memory and print only the\
+ given number of most frequent qualifiers per event and interval, followed by\
+ the largest possible overcount of the interval")
+    parser.add_option("--error",
+        action="store",
+        default=0.001,
+        dest="error",
+        metavar="<ratio>",
+        type="float",
+        help="largest overcount of --top relative to the number of events\
+ in the interval, the default is 0.001")
+    parser.add_option("-s", "--store",
+        action="store",
+        dest="store",
+        metavar="<dir>",
+        help="event store directory of the builtin --ecs patterns, the counts\
+ are read from the store. Log files are appended to it with --ingest only")
+    parser.add_option("--ingest",
+        action="store_true",
+        default=False,
+        dest="ingest",
+        help="append the log files, the parts of them not appended already,\
+ to the store of -s and exit")
+    parser.add_option("-w", "--where",
+        action="extend",
+        type="string",
+        dest="where",
+        metavar="<qualifier>",
+        help='count only the events with this qualifier, for example\
+ "-w d1=71f2", requires -s')
     parser.add_option("-z",
         action="store_true",
         default=False,
         dest="print_zero",
         help="print 0 instead of empty field in the output report")
 
+    parser.add_option("--benchmark",
+        action="store_true",
+        default=False,
+        dest="benchmark",
+        help=SUPPRESS_HELP)
+
     group = OptionGroup(parser,
  "Convenience options for Avaya Communication Manager")
     group.add_option("--ecs",
@@ -426,7 +1131,16 @@ def parse_args(args):
 
     args = {}
     args["verbosity"] = options.verbosity
+    args["benchmark"] = options.benchmark
     args["buffsize"] = options.buffsize
+    args["jobs"] = options.jobs
+    args["follow"] = options.follow
+    args["top"] = options.top
+    args["counter"] = Counter
+    if options.top > 0:
+        if not 0 < options.error < 1:
+            parser.error("--error must be between 0 and 1")
+        args["counter"] = HeavyHittersFactory(options.top, options.error)
     args["print_zero"] = options.print_zero
     args["patterns"] = OrderedDict()
     args["logfiles"] = []
@@ -454,9 +1168,25 @@ def parse_args(args):
         #this doesnt work in Python 2.4
         #custom_ranges = [(s,e) if e else (s,s) for s,_,e in
                  #(t.partition('-') for t in sorted(options.custom_ranges))]
-        args["custom_ranges"] = parse_ranges(options.custom_ranges)
-        if args["custom_ranges"]:
-            args["timepos"] = (0, len(args["custom_ranges"][0][0]))
+        ranges = parse_ranges(options.custom_ranges)
+        if ranges:
+            args["custom_ranges"] = RangeIndex(ranges)
+            args["timepos"] = (0, len(ranges[0][0]))
+
+    args["store"] = options.store
+    args["ingest"] = options.ingest
+    args["where"] = options.where or []
+    if (options.ingest or options.where) and not options.store:
+        parser.error("--ingest and -w require -s")
+    if options.store:
+        for event, regex in args["patterns"].iteritems():
+            if STORE_PATTERNS.get(event) != regex:
+                parser.error("-s stores only the --ecs patterns")
+        if args["timepos"][1] > 18:
+            parser.error("-s stores the timestamps to the millisecond")
+        if arguments and not options.ingest:
+            parser.error("-s counts the store only, log files are appended\
+ to it with --ingest")
 
     if arguments:
         logs = []
@@ -469,8 +1199,94 @@ def parse_args(args):
         args["logfiles"] = logfiles
     return args
 
-def main(args):
-    args = parse_args(args)
+def follow_logs(logdir, files="20*", sleep=1, idle=None):
+    '''
+    Generates the lines appended to the newest log file in logdir from the
+    time of the call. When a newer log file appears the rest of the current
+    one is read and the newer one is followed from its beginning. The idle
+    function, if given, is called each time before sleeping for new lines.
+    '''
+    path = os.path.join(logdir, files)
+    logs = glob(path)
+    if not logs:
+        raise IOError("No log files found: %s" % path)
+    logfile = max(logs)
+    fd = open(logfile)
+    fd.seek(0, 2)
+    partial = ""
+    while 1:
+        line = fd.readline()
+        if line:
+            if not line.endswith("\n"):
+                partial += line
+                continue
+            if partial:
+                line, partial = partial + line, ""
+            yield line
+            continue
+        newest = max(glob(path) or [logfile])
+        if newest != logfile:
+            line = fd.readline()
+            if line:
+                fd.seek(-len(line), 1)
+                continue
+            fd.close()
+            logfile = newest
+            fd = open(logfile)
+            partial = ""
+            continue
+        if idle is not None:
+            idle()
+        time.sleep(sleep)
+
+def count_follow(args):
+    '''
+    Counts the events of the ecs log being written and redraws the tables
+    on the terminal, the interval in progress included, at most every
+    REDRAW_INTERVAL seconds while the counts change and as soon as the log
+    is idle. Only the last buffsize intervals are kept so memory and CPU
+    stay constant.
+    '''
+    if args["logfiles"]:
+        logdir = os.path.dirname(args["logfiles"][-1]) or "."
+    else:
+        logdir = ECS_LOGDIR
+    intervals = OrderedDict()
+    screen = LiveScreen()
+    #time of the first change of the counts not drawn yet, None if none
+    drawn = [0]
+    def redraw():
+        if drawn[0] is not None:
+            screen.draw([interval_cells(intervals[e], name=e,
+                                        print_zero=args["print_zero"])
+                         for e in intervals])
+            drawn[0] = None
+    lines = follow_logs(logdir, idle=redraw)
+    events = itermatches(lines, args["patterns"], args["timepos"])
+    custom_ranges = args["custom_ranges"]
+    for ts, event, qualifiers in events:
+        if custom_ranges:
+            ts = custom_ranges.lookup(ts)
+            if ts is None:
+                continue
+        table = intervals.get(event)
+        if table is None:
+            table = intervals[event] = LimitedSizeDict(size=args["buffsize"])
+        c = table.get(ts)
+        if c is None:
+            c = table[ts] = args["counter"]()
+        c.update([' '.join(qualifiers[:args["verbosity"]])])
+        now = time.time()
+        if drawn[0] is None:
+            drawn[0] = now
+        elif now - drawn[0] >= REDRAW_INTERVAL:
+            redraw()
+
+def count_serial(args):
+    '''
+    Counts the events of the logfiles, or of stdin, in this process.
+    :return: OrderedDict of event: LimitedSizeDict of interval: Counter
+    '''
     events = iterevents(args["patterns"], args["logfiles"], args["timepos"])
     custom_ranges = args["custom_ranges"]
     intervals = OrderedDict()
@@ -479,17 +1295,87 @@ def main(args):
     for item in events:
         ts, event, qualifiers = item
         if custom_ranges:
-            start_end = [(s,e) for s,e in custom_ranges if s<=ts[0:len(s)]<=e]
-            if start_end:
-                ts = '-'.join(start_end[0])
-            else:
-                continue 
-        intervals.setdefault(event, LimitedSizeDict(size=args["buffsize"])
-                ).setdefault(ts, Counter()
-                ).update([' '.join(qualifiers[:args["verbosity"]])])
+            ts = custom_ranges.lookup(ts)
+            if ts is None:
+                continue
+        table = intervals.get(event)
+        if table is None:
+            table = intervals[event] = LimitedSizeDict(size=args["buffsize"])
+        c = table.get(ts)
+        if c is None:
+            c = table[ts] = args["counter"]()
+        c.update([' '.join(qualifiers[:args["verbosity"]])])
+    return intervals
+
+def count_logfiles(args):
+    '''
+    Counts the events of the logfiles, or of stdin, in one or more processes.
+    :return: OrderedDict of event: LimitedSizeDict of interval: Counter or
+             None if none of the logfiles has to be read
+    '''
+    if args["custom_ranges"] and args["logfiles"]:
+        args["logfiles"] = select_logfiles(args["logfiles"],
+                                           args["custom_ranges"])
+        if not args["logfiles"]:
+            return None
+    if (args["jobs"] > 1 and len(args["logfiles"]) > 1 and
+            multiprocessing is not None):
+        return count_parallel(args)
+    return count_serial(args)
+
+def count_store(args):
+    '''
+    Counts the events of the event store in args["store"]. The counts per
+    minute are used unless the intervals or the custom ranges are finer.
+    :return: OrderedDict of event: LimitedSizeDict of interval: Counter
+    '''
+    store = EventStore(args["store"])
+    custom_ranges = args["custom_ranges"]
+    minutes = args["timepos"][1] <= 13
+    if custom_ranges:
+        minutes = minutes and max([len(s) for s, e in
+                                   custom_ranges.ranges]) <= 13
+    ts_slice = slice(*args["timepos"])
+    intervals = OrderedDict()
+    for ts, event, qualifiers, n in store.events(args["patterns"],
+            args["where"], custom_ranges, minutes):
+        ts = ts[ts_slice]
+        if custom_ranges:
+            ts = custom_ranges.lookup(ts)
+            if ts is None:
+                continue
+        table = intervals.get(event)
+        if table is None:
+            table = intervals[event] = LimitedSizeDict(size=args["buffsize"])
+        c = table.get(ts)
+        if c is None:
+            c = table[ts] = args["counter"]()
+        c.update({' '.join(qualifiers[:args["verbosity"]]): n})
+    return intervals
+
+def main(args):
+    args = parse_args(args)
+    if args["benchmark"]:
+        return benchmark(args["patterns"], args["logfiles"])
+    if args["follow"]:
+        return count_follow(args)
+    if args["store"]:
+        if args["ingest"]:
+            EventStore(args["store"]).ingest(args["logfiles"])
+            return
+        intervals = count_store(args)
+    else:
+        intervals = count_logfiles(args)
+        if intervals is None:
+            return
     for event in intervals:
+        footer = None
+        if args["top"]:
+            footer = ("overcount<=", dict((ts, c.overcount())
+                      for ts, c in intervals[event].iteritems()))
         print pprint_intervals(intervals[event], name=event,
-                               print_zero=args["print_zero"]), "\n"
+                               print_zero=args["print_zero"],
+                               footer=footer), "\n"
 
 if __name__ == "__main__":
     try:
@@ -1,32 +1,201 @@
+import os
 import sys
 import re
-
-if len(sys.argv) != 3:
-    print 'usage: %s "<pattern1[|pattern2]>" <MST filename>' % sys.argv[0]
-    sys.exit(1)
+import tempfile
+from optparse import OptionParser
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
 
 reFirstMsg = re.compile(r'\s*\d+\s*\d+:\d+:\d+')
-patterns = sys.argv[1]
-filename = sys.argv[2]
-buffer = []
-line = ''
+CHUNKSIZE = 4 * 1024 * 1024
+MAX_SCAN_PATTERNS = 10
+
+
+class PatternMatcher(object):
+    '''
+    Finds any of the patterns in a text in one pass. Up to
+    MAX_SCAN_PATTERNS patterns are looked for with str.find, more than
+    that with one regex of the trie of the patterns, which the re module
+    walks as an automaton at each position of the text.
+    '''
+    def __init__(self, patterns):
+        self.patterns = patterns
+        self.regex = None
+        if len(patterns) > MAX_SCAN_PATTERNS:
+            self.regex = re.compile(self.trie_regex(patterns))
+        self.text = None
+        self.next = None
+
+    @staticmethod
+    def trie_regex(patterns):
+        trie = {}
+        for pattern in patterns:
+            node = trie
+            for char in pattern:
+                node = node.setdefault(char, {})
+            node[''] = {}
+        def build(node):
+            #a pattern ending here is enough, longer ones need not be tried
+            if '' in node:
+                return ''
+            alternatives = [re.escape(char) + build(child) for char, child in
+                            sorted(node.iteritems())]
+            if len(alternatives) == 1:
+                return alternatives[0]
+            return '(?:' + '|'.join(alternatives) + ')'
+        return build(trie) or '(?:)'
 
-fd = open(filename, 'rU')
+    def first(self, text, start):
+        '''Returns the start of the leftmost match from start or -1.'''
+        if text is not self.text:
+            self.text = text
+            self.next = [-2] * len(self.patterns)
+        if self.regex is not None:
+            if self.next[0] == -1 or self.next[0] >= start:
+                return self.next[0]
+            m = self.regex.search(text, start)
+            if m is None:
+                self.next[0] = -1
+            else:
+                self.next[0] = m.start()
+            return self.next[0]
+        first = -1
+        for n, pattern in enumerate(self.patterns):
+            pos = self.next[n]
+            if pos != -1 and pos < start:
+                pos = self.next[n] = text.find(pattern, start)
+            if pos != -1 and (first == -1 or pos < first):
+                first = pos
+        return first
 
-while not reFirstMsg.match(line):
+    def within(self, text, start, end):
+        '''Returns True if any pattern is in text[start:end].'''
+        if self.regex is not None:
+            return self.regex.search(text, start, end) is not None
+        for pattern in self.patterns:
+            if text.find(pattern, start, end) != -1:
+                return True
+        return False
+
+
+def itermessages(text, start=0):
+    '''
+    Generates the (start, end) of the messages in text from start, a message
+    being closed by the first empty line which is at least its third line.
+    The start of the unfinished message is sent back by the last item with
+    an end of None.
+    '''
+    pos, nlines = start, 0
+    while 1:
+        if text.startswith('\n', pos):
+            blank = pos
+        else:
+            blank = text.find('\n\n', pos)
+            if blank == -1:
+                break
+            blank += 1
+            nlines += text.count('\n', pos, blank)
+        if nlines >= 2:
+            yield start, blank + 1
+            start, pos, nlines = blank + 1, blank + 1, 0
+        else:
+            nlines += 1
+            pos = blank + 1
+    yield start, None
+
+
+def extract(patterns, fd, out, chunksize=CHUNKSIZE):
+    matcher = PatternMatcher(patterns)
     line = fd.readline()
-buffer.append(line)
-
-for line in fd:
-    if line.startswith('\n') and len(buffer) > 1:
-        buffer.append(line)
-        message = ''.join(buffer)
-        for pattern in patterns.split('|'):
-            if pattern in message:
-                print message
+    while line and not reFirstMsg.match(line):
+        line = fd.readline()
+    text = line
+    while line:
+        data = fd.read(chunksize)
+        if not data:
+            break
+        text += data
+        matches = []
+        for start, end in itermessages(text):
+            if end is None:
+                text = text[start:]
                 break
-        buffer = []
-    else:
-        buffer.append(line)
+            first = matcher.first(text, start)
+            if first == -1 or first >= end:
+                continue
+            if matcher.within(text, start, end):
+                matches.append(text[start:end])
+                matches.append('\n')
+        if matches:
+            out.write(''.join(matches))
+
+
+def extract_file(task):
+    patterns, filename, tmpdir = task
+    handle, tmpfile = tempfile.mkstemp(dir=tmpdir, suffix='.extract')
+    out = os.fdopen(handle, 'wb', 1024*1024)
+    try:
+        fd = open(filename, 'rU')
+        try:
+            extract(patterns, fd, out)
+        finally:
+            fd.close()
+    finally:
+        out.close()
+    return tmpfile
+
+
+def main():
+    parser = OptionParser(
+        usage='%prog "<pattern1[|pattern2]>" <MST filename> [<MST filename>...]')
+    parser.add_option('-j', '--jobs',
+        action='store',
+        default=1,
+        dest='jobs',
+        type='int',
+        help='number of MST files to extract from in parallel, the output is\
+ in the order of the files, the default is 1')
+    opts, args = parser.parse_args()
+    if len(args) < 2:
+        parser.print_usage()
+        return 1
+    patterns = args[0].split('|')
+    filenames = args[1:]
+    out = os.fdopen(os.dup(sys.stdout.fileno()), 'wb', 1024*1024)
+    try:
+        if opts.jobs > 1 and len(filenames) > 1 and multiprocessing is not None:
+            tmpdir = tempfile.mkdtemp(prefix='extract')
+            pool = multiprocessing.Pool(min(opts.jobs, len(filenames)))
+            try:
+                tasks = [(patterns, x, tmpdir) for x in filenames]
+                for tmpfile in pool.imap(extract_file, tasks):
+                    fd = open(tmpfile, 'rb')
+                    try:
+                        while 1:
+                            data = fd.read(1024*1024)
+                            if not data:
+                                break
+                            out.write(data)
+                    finally:
+                        fd.close()
+                    os.remove(tmpfile)
+                pool.close()
+            finally:
+                pool.terminate()
+                for tmpfile in os.listdir(tmpdir):
+                    os.remove(os.path.join(tmpdir, tmpfile))
+                os.rmdir(tmpdir)
+        else:
+            for filename in filenames:
+                fd = open(filename, 'rU')
+                try:
+                    extract(patterns, fd, out)
+                finally:
+                    fd.close()
+    finally:
+        out.close()
 
-fd.close()
+if __name__ == '__main__':
+    sys.exit(main())
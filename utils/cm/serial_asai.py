@@ -11,9 +11,15 @@
 import os
 os.nice(19)
 import sys
+import time
+from array import array
 from itertools import izip
 from optparse import OptionParser, SUPPRESS_HELP
 from binascii import unhexlify
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 try:
     from collections import OrderedDict
 except ImportError:
@@ -142,6 +148,15 @@ DEFAULT_FIELDS = [
                   "event"
                   ]
 
+#events after which a call does not get more ASAI DOMAIN messages
+FINAL_EVENTS = ("call ended", "call cleared")
+#number of messages after which a call not seen is considered finished
+MAX_IDLE = 100000
+#number of messages a UCID is kept for after its last call finished
+GRACE = 1000
+#number of UCID and UUI conversions memoized
+MEMO_SIZE = 1024
+
 class ASAICall(object):
     def __init__(self, callid):
         self.callid = callid
@@ -204,6 +219,171 @@ class ASAICall(object):
         return "\n".join(out)
 
 
+def memoize(func, maxsize=MEMO_SIZE):
+    '''
+    This decorator serves to cache the return value of 'func' for a given
+    input in 'args' and returns the cached value if available when called
+    with the same input in 'args'. Only the 'maxsize' most recently used
+    values are kept, the least recently used one is dropped first.
+    It is used to cache the UCID and UUI conversions which are repeated for
+    every message of a call, but are unique to the call.
+    :param func: function to be wrapped
+    :param maxsize: maximum number of cached values
+    :return: function, a wrapped function
+    '''
+    cache = OrderedDict()
+    def wrapper(*args):
+        try:
+            result = cache.pop(args)
+        except KeyError:
+            result = func(*args)
+            if len(cache) >= maxsize:
+                cache.popitem(last=False)
+        cache[args] = result
+        return result
+    return wrapper
+
+
+class ASAIDomainFields(object):
+    '''
+    Slotted record of every field of an ASAI DOMAIN message. It is filled in
+    by decode_asai_domain() when the message is decoded. The ucid and
+    uui fields are kept in their raw hex format.
+    '''
+    __slots__ = ["timestamp", "crv", "link", "type", "callids", "calling",
+                 "called", "connected", "event", "trunks", "ucid", "uui"]
+    def __init__(self):
+        self.timestamp = ""
+        self.crv = ""
+        self.link = ""
+        self.type = ""
+        self.callids = []
+        self.calling = ""
+        self.called = ""
+        self.connected = []
+        self.event = ""
+        self.trunks = []
+        self.ucid = ""
+        self.uui = ""
+
+
+def _crv(s, start):
+    start_crv = s.find("_", start+4) + 1
+    return s[start_crv:start_crv + 4]
+
+def _link(s, start):
+    start_link = s.find(" ", start+16)
+    end_link = s.find("\n", start_link)
+    if end_link < 0:
+        end_link = None
+    return str(int(s[start_link:end_link].strip()))
+
+def _type(s, start):
+    start_type = s.find(" ", start+22)
+    end_type = s.find("\n", start_type)
+    if end_type < 0:
+        end_type = None
+    return s[start_type:end_type].strip()
+
+def _number(offset):
+    def number(s, start):
+        start_num = s.find(" ", start+offset) + 1
+        end_num = s.find("\n", start_num)
+        if end_num < 0:
+            end_num = None
+        return s[start_num:end_num]
+    return number
+
+def _callid(s, start):
+    start_callid = s.find(" ", start+13) + 1
+    end_callid = s.find("  ", start_callid)
+    if end_callid < 0:
+        end_callid = None
+    return s[start_callid:end_callid].replace(" ", "")
+
+def _event(s, start):
+    start_event = s.find(" ", start+17)
+    end_event = s.find("\n", start_event)
+    if end_event < 0:
+        end_event = None
+    return s[start_event:end_event].strip()
+
+def _trunk(s, start):
+    start_trk = s.find(" ", start+7) + 1
+    end_trk = s.find("\n", start_trk)
+    if end_trk < 0:
+        end_trk = None
+    return s[start_trk:end_trk].replace(" trk ", "/")
+
+def _ucid(s, start):
+    start_ucid = s.find(" ", start+17) + 1
+    end_ucid = s.find("  ", start_ucid)
+    if end_ucid < 0:
+        end_ucid = None
+    return s[start_ucid:end_ucid].replace(" ", "")
+
+def _uui(s, start):
+    start_uui = s.find("|", start+32) + 3
+    end_uui = s.find("<-", start_uui)
+    if end_uui < 0:
+        end_uui = None
+    return "".join(x for x in s[start_uui:end_uui].split() if x != "|")
+
+#keyword: (field, extractor, repeated)
+DOMAIN_KEYWORDS = {
+    "crv"                    : ("crv", _crv, False),
+    "CTI Link number"        : ("link", _link, False),
+    "ASAI association type"  : ("type", _type, False),
+    "CALL IDENTITY"          : ("callids", _callid, True),
+    "CALLING PARTY NUMBER"   : ("calling", _number(21), False),
+    "CALLED PARTY NUMBER"    : ("called", _number(20), False),
+    "CONNECTED NUMBER"       : ("connected", _number(17), True),
+    "SPECIFIC EVENT"         : ("event", _event, False),
+    "SNC grp"                : ("trunks", _trunk, True),
+    "UNIVERSAL CALL ID"      : ("ucid", _ucid, False),
+    "user-specific protocol" : ("uui", _uui, False),
+}
+DOMAIN_KEYWORD_ITEMS = sorted(DOMAIN_KEYWORDS.items())
+
+def decode_asai_domain(s):
+    '''
+    Decodes every field of the ASAI DOMAIN message into an ASAIDomainFields
+    record in one go, each keyword is located only once, or once per
+    occurrence for the repeated fields (callids, connected, trunks), of
+    which all are collected in order. A field which fails to be extracted
+    is left empty, so that it does not prevent access to the others.
+    :param s: string, ASAI DOMAIN message as yielded by the reader
+    :return: ASAIDomainFields instance
+    '''
+    fields = ASAIDomainFields()
+    start = s.find(" ", 0)
+    if start >= 0:
+        start_time = start+2
+        end_time = s.find(" ", start_time)
+        if end_time < 0:
+            end_time = None
+        fields.timestamp = s[start_time:end_time]
+    find = s.find
+    for keyword, (field, extractor, repeated) in DOMAIN_KEYWORD_ITEMS:
+        start = find(keyword)
+        if start < 0:
+            continue
+        if not repeated:
+            try:
+                setattr(fields, field, extractor(s, start))
+            except ValueError:
+                pass
+            continue
+        values = getattr(fields, field)
+        while start != -1:
+            try:
+                values.append(extractor(s, start))
+            except ValueError:
+                pass
+            start = find(keyword, start+1)
+    return fields
+
+
 class ASAIMsg(object):
     def __init__(self, msg):
         self._str = msg
@@ -247,109 +427,68 @@ class ASAIMsg(object):
 
 
 class ASAIDomainMsg(ASAIMsg):
+    '''
+    Lazy facade over decode_asai_domain(), the message is decoded only once
+    when the first field is accessed, the most recent UCID and UUI
+    conversions are memoized.
+    '''
     def __init__(self, msg, ucid_dec=True, uui_ascii=True):
         super(ASAIDomainMsg, self).__init__(msg)
         self.ucid_dec = ucid_dec
         self.uui_ascii = uui_ascii
+        self._fields = None
+    @classmethod
+    def from_fields(cls, fields, ucid_dec=True, uui_ascii=True):
+        '''Returns an instance wrapping an already decoded record.'''
+        msg = cls("", ucid_dec, uui_ascii)
+        msg._fields = fields
+        return msg
+    def _decode(self):
+        self._fields = decode_asai_domain(self._str)
+        return self._fields
+    @property
+    def fields(self):
+        return self._fields or self._decode()
+    @property
+    def crv(self):
+        return (self._fields or self._decode()).crv
+    @property
+    def link(self):
+        return (self._fields or self._decode()).link
+    @property
+    def timestamp(self):
+        return (self._fields or self._decode()).timestamp
+    @property
+    def type(self):
+        return (self._fields or self._decode()).type
     @property
     def calling(self):
-        start = self._str.find("CALLING PARTY NUMBER")
-        if start < 0:
-            return ""
-        start_num = self._str.find(" ", start+21) + 1
-        end_num = self._str.find("\n", start_num)
-        if end_num < 0:
-            end_num = None
-        return self._str[start_num:end_num]
+        return (self._fields or self._decode()).calling
     @property
     def called(self):
-        start = self._str.find("CALLED PARTY NUMBER")
-        if start < 0:
-            return ""
-        start_num = self._str.find(" ", start+20) + 1
-        end_num = self._str.find("\n", start_num)
-        if end_num < 0:
-            end_num = None
-        return self._str[start_num:end_num]
+        return (self._fields or self._decode()).called
     @property
     def callids(self):
-        start = self._str.find("CALL IDENTITY")
-        if start < 0:
-            return []
-        ids = []
-        while start != -1: 
-            start_callid = self._str.find(" ", start+13) + 1
-            end_callid = self._str.find("  ", start_callid)
-            if end_callid < 0:
-                end_callid = None
-            ids.append(self._str[start_callid:end_callid].replace(" ",""))
-            start = self._str.find("CALL IDENTITY", start+1)
-        return ids
+        return (self._fields or self._decode()).callids
     @property
     def connected(self):
-        start = self._str.find("CONNECTED NUMBER")
-        if start < 0:
-            return []
-        nums = []
-        while start != -1:
-            start_num = self._str.find(" ", start+17) + 1
-            end_num = self._str.find("\n", start_num)
-            if end_num < 0:
-                end_num = None
-            nums.append(self._str[start_num:end_num])
-            start = self._str.find("CONNECTED NUMBER", start+1)
-        return nums
+        return (self._fields or self._decode()).connected
     @property
     def event(self):
-        start = self._str.find("SPECIFIC EVENT")
-        if start < 0:
-            return ""
-        start_event = self._str.find(" ", start+17)
-        end_event = self._str.find("\n", start_event)
-        if end_event < 0:
-            end_event = None
-        return self._str[start_event:end_event].strip()
+        return (self._fields or self._decode()).event
     @property
     def trunks(self):
-        start = self._str.find("SNC grp")
-        if start < 0:
-            return []
-        trks = []
-        while start != -1:
-            start_trk = self._str.find(" ", start+7) + 1
-            end_trk = self._str.find("\n", start_trk)
-            if end_trk < 0:
-                end_trk = None
-            trks.append(self._str[start_trk:end_trk].replace(" trk ", "/"))
-            start = self._str.find("SNC grp", start+1)
-        return trks
+        return (self._fields or self._decode()).trunks
     @property
     def ucid(self):
-        start = self._str.find("UNIVERSAL CALL ID")
-        if start < 0:
-            return ""
-        start_ucid = self._str.find(" ", start+17) + 1
-        end_ucid = self._str.find("  ", start_ucid)
-        if end_ucid < 0:
-            end_ucid = None
-        ucid = self._str[start_ucid:end_ucid].replace(" ", "")
         if self.ucid_dec:
-            return self.ucid_to_dec(ucid)
-        return ucid
+            return memo_ucid_to_dec((self._fields or self._decode()).ucid)
+        return (self._fields or self._decode()).ucid
     @property
     def uui(self):
-        start = self._str.find("user-specific protocol")
-        if start < 0:
-            return ""
-        start_uui = self._str.find("|", start+32) + 3
-        end_uui = self._str.find("<-", start_uui)
-        if end_uui < 0:
-            end_uui = None
-        uui = self._str[start_uui:end_uui]
-        uui = "".join(x for x in uui.split() if x != "|")
         if self.uui_ascii:
-            return self.uui_to_ascii(uui)
-        return uui
+            return memo_uui_to_ascii((self._fields or self._decode()).uui)
+        return (self._fields or self._decode()).uui
     @staticmethod
     def ucid_to_dec(ucid):
         if ucid:
@@ -372,6 +511,9 @@ class ASAIDomainMsg(ASAIMsg):
                 return "<uui_to_ascii failed>"
         return ""
 
+memo_ucid_to_dec = memoize(ASAIDomainMsg.ucid_to_dec)
+memo_uui_to_ascii = memoize(ASAIDomainMsg.uui_to_ascii)
+
 def ucid_hex_to_dec(ucid):
     if ucid:
         try:
@@ -435,6 +577,383 @@ def get_calls(mstfiles):
                 asai_calls.setdefault(callid, ASAICall(callid)).update(msg)
     return asai_calls 
 
+
+class ASAICallStore(object):
+    '''
+    Column store of decoded ASAI DOMAIN messages. Every field of a message
+    is interned in a shared value table and only its integer id is kept in
+    a compact array per field. Secondary hash indexes map callids, links,
+    calling/called/connected numbers, trunk/channels and decimal UCIDs to
+    the array of message rows they appear in, so filtered queries are index
+    lookups instead of a re-parse of the MST files. The store can be saved
+    to and loaded from a file, it is keyed by the name, size and mtime of
+    the MST files it was built from.
+    '''
+    VERSION = 1
+    COLUMNS = ASAIDomainFields.__slots__
+    INDEXES = ["callid", "link", "number", "trunk", "ucid"]
+    def __init__(self, signature=None):
+        self.signature = signature
+        self.values = [""]
+        self.value_ids = {"": 0}
+        self.columns = dict((c, array("i")) for c in self.COLUMNS)
+        self.indexes = dict((i, {}) for i in self.INDEXES)
+    def __len__(self):
+        return len(self.columns["timestamp"])
+    def _intern(self, value):
+        try:
+            return self.value_ids[value]
+        except KeyError:
+            self.value_ids[value] = len(self.values)
+            self.values.append(value)
+            return self.value_ids[value]
+    def _index(self, name, keys, row):
+        index = self.indexes[name]
+        for key in keys:
+            rows = index.get(key)
+            if rows is None:
+                index[key] = array("i", [row])
+            elif rows[-1] != row:
+                rows.append(row)
+    def add(self, fields):
+        '''
+        Appends a decoded message to the store and indexes it.
+        :param fields: ASAIDomainFields instance
+        :return: int, the row number of the message
+        '''
+        row = len(self)
+        for name in self.COLUMNS:
+            value = getattr(fields, name)
+            if isinstance(value, list):
+                value = tuple(value)
+            self.columns[name].append(self._intern(value))
+        self._index("callid", fields.callids, row)
+        self._index("link", [fields.link], row)
+        self._index("number", [fields.calling, fields.called] +
+                              fields.connected, row)
+        self._index("trunk", fields.trunks, row)
+        self._index("ucid", [memo_ucid_to_dec(fields.ucid)], row)
+        return row
+    def fields(self, row):
+        '''Returns the ASAIDomainFields record of message in 'row'.'''
+        fields = ASAIDomainFields()
+        values = self.values
+        for name in self.COLUMNS:
+            value = values[self.columns[name][row]]
+            if isinstance(value, tuple):
+                value = list(value)
+            setattr(fields, name, value)
+        return fields
+    def callids(self):
+        '''Returns the callids in the order of their first appearance.'''
+        seen = set()
+        callids = []
+        values = self.values
+        for value_id in self.columns["callids"]:
+            for callid in values[value_id]:
+                if callid and callid not in seen:
+                    seen.add(callid)
+                    callids.append(callid)
+        return callids
+    def call_rows(self, callid):
+        '''Returns the rows of the messages of 'callid'.'''
+        return self.indexes["callid"].get(callid, ())
+    def messages(self, rows):
+        '''Generates ASAIDomainMsg instances of the messages in 'rows'.'''
+        for row in rows:
+            yield ASAIDomainMsg.from_fields(self.fields(row))
+    def query(self, callid=None, link=None, number=None, trunk=None,
+              ucid=None):
+        '''
+        Returns the rows of the messages matching all the provided filters,
+        a message matches a filter if any of its values is in the filter.
+        :param callid, link, number, trunk, ucid: set of strings or None
+        :return: list of rows in the order the messages were added
+        '''
+        rows = None
+        for name, keys in (("link", link), ("callid", callid),
+                           ("number", number), ("trunk", trunk),
+                           ("ucid", ucid)):
+            if not keys:
+                continue
+            index = self.indexes[name]
+            matched = set()
+            for key in keys:
+                matched.update(index.get(key, ()))
+            if rows is None:
+                rows = matched
+            else:
+                rows &= matched
+            if not rows:
+                return []
+        if rows is None:
+            return xrange(len(self))
+        return sorted(rows)
+    @staticmethod
+    def files_signature(mstfiles):
+        signature = []
+        for mstfile in mstfiles:
+            try:
+                st = os.stat(mstfile)
+            except OSError:
+                continue
+            signature.append((os.path.abspath(mstfile), st.st_size,
+                              int(st.st_mtime)))
+        return signature
+    @classmethod
+    def build(cls, mstfiles):
+        store = cls(cls.files_signature(mstfiles))
+        for asai_domain_msg in asai_domain_mst_reader(mstfiles):
+            store.add(decode_asai_domain(asai_domain_msg))
+        return store
+    def save(self, path):
+        '''Writes the store to 'path' through a temporary file.'''
+        state = {
+            "version": self.VERSION,
+            "signature": self.signature,
+            "values": self.values,
+            "columns": dict((k, v.tostring()) for k, v in
+                            self.columns.iteritems()),
+            "indexes": dict((k, dict((key, rows.tostring()) for key, rows in
+                             v.iteritems())) for k, v in
+                            self.indexes.iteritems()),
+        }
+        tmp = path + ".tmp"
+        fd = open(tmp, "wb")
+        try:
+            pickle.dump(state, fd, 2)
+        finally:
+            fd.close()
+        os.rename(tmp, path)
+    @classmethod
+    def load(cls, path):
+        '''
+        Reads a store saved by save().
+        :return: ASAICallStore or None if the file is not a valid store
+        '''
+        try:
+            fd = open(path, "rb")
+            try:
+                state = pickle.load(fd)
+            finally:
+                fd.close()
+        except:
+            return None
+        if not isinstance(state, dict) or state.get("version") != cls.VERSION:
+            return None
+        store = cls(state["signature"])
+        store.values = state["values"]
+        store.value_ids = dict((v, i) for i, v in enumerate(store.values))
+        for name, data in state["columns"].iteritems():
+            store.columns[name] = array("i")
+            store.columns[name].fromstring(data)
+        for name, index in state["indexes"].iteritems():
+            for key, data in index.iteritems():
+                rows = array("i")
+                rows.fromstring(data)
+                store.indexes[name][key] = rows
+        return store
+    @classmethod
+    def open(cls, path, mstfiles=None):
+        '''
+        Returns the store saved in 'path' if it was built from 'mstfiles',
+        otherwise builds it from 'mstfiles' and saves it to 'path'. Without
+        'mstfiles' the saved store is returned as it is, or None if it
+        cannot be loaded, 'path' is left untouched in that case.
+        '''
+        store = None
+        if os.path.isfile(path):
+            store = cls.load(path)
+            if (store is not None and mstfiles and
+                    store.signature != cls.files_signature(mstfiles)):
+                store = None
+        if store is None and mstfiles:
+            store = cls.build(mstfiles)
+            store.save(path)
+        return store
+
+def iterfiltered(mstfiles, filter_link=None, filter_callid=None,
+                 filter_num=None, filter_trk=None, filter_ucid=None):
+    reader = asai_domain_mst_reader(mstfiles)
+    for asai_domain_msg in reader:
+        msg = ASAIDomainMsg(asai_domain_msg)
+        if filter_link and msg.link not in filter_link:
+            continue
+        if filter_callid and not filter_callid & set(msg.callids):
+            continue
+        elif filter_num and not filter_num & set([msg.calling,
+                                                  msg.called] +
+                                               msg.connected):
+            continue
+        elif filter_trk and not filter_trk & set(msg.trunks):
+            continue
+        elif filter_ucid and msg.ucid not in filter_ucid:
+            continue
+        yield msg
+
+def correlate_ucids(msgs):
+    ucids = {}
+    for msg in msgs:
+        if not [x for x in msg.callids if x]:
+            continue
+        ucid, calling = msg.ucid, msg.calling
+        if ucid and calling and len(calling) > 8:
+            ucids.setdefault(ucid, set()).add(calling)
+    return ucids
+
+class UCIDCorrelator(object):
+    '''
+    Streaming correlation of UCIDs with the calling numbers of the calls
+    they were seen in. Only the open calls are kept, a call is finished when
+    one of its messages reports one of the 'final_events' or when it was not
+    seen in the last 'max_idle' messages. A UCID is completed 'grace'
+    messages after the last open call it was seen in finished, unless a new
+    call reuses it in the meantime, so that the calls of a UCID reused by a
+    transfer, a conference or another link are correlated together. The
+    calling numbers of a completed UCID are returned and released, so the
+    memory used is bounded by the number of concurrent calls and of the
+    UCIDs finished within 'grace' messages, not by the total number of calls.
+    '''
+    def __init__(self, final_events=FINAL_EVENTS, max_idle=MAX_IDLE,
+                 grace=GRACE):
+        self.final_events = final_events
+        self.max_idle = max_idle
+        self.grace = grace
+        self.msgs = 0
+        self.open_calls = OrderedDict()
+        self.last_seen = {}
+        self.ucid_calls = {}
+        self.finished = OrderedDict()
+        self.callers = {}
+    def is_final(self, event):
+        for final_event in self.final_events:
+            if event.startswith(final_event):
+                return True
+        return False
+    def update(self, msg):
+        '''
+        Feeds the next ASAI DOMAIN message to the correlator.
+        :param msg: ASAIDomainMsg instance
+        :return: list of (ucid, set of calling numbers) completed
+        '''
+        self.msgs += 1
+        completed = []
+        callids = [x for x in msg.callids if x]
+        if callids:
+            ucid, calling = msg.ucid, msg.calling
+            if ucid:
+                self.finished.pop(ucid, None)
+                callers = self.callers.setdefault(ucid, set())
+                if calling and len(calling) > 8:
+                    callers.add(calling)
+            for callid in callids:
+                ucids = self.open_calls.pop(callid, None)
+                if ucids is None:
+                    ucids = set()
+                if ucid:
+                    ucids.add(ucid)
+                    self.ucid_calls.setdefault(ucid, set()).add(callid)
+                self.open_calls[callid] = ucids
+                self.last_seen[callid] = self.msgs
+            if self.is_final(msg.event):
+                for callid in callids:
+                    self.finish(callid)
+        while self.open_calls:
+            oldest = iter(self.open_calls).next()
+            if self.msgs - self.last_seen[oldest] < self.max_idle:
+                break
+            self.finish(oldest)
+        while self.finished:
+            oldest = iter(self.finished).next()
+            if self.msgs - self.finished[oldest] < self.grace:
+                break
+            completed.extend(self.complete(oldest))
+        return completed
+    def finish(self, callid):
+        '''
+        Finishes the call of 'callid', the UCIDs without open calls left
+        are completed after 'grace' messages.
+        :return: None
+        '''
+        ucids = self.open_calls.pop(callid, None)
+        if ucids is None:
+            return
+        del self.last_seen[callid]
+        for ucid in ucids:
+            calls = self.ucid_calls[ucid]
+            calls.discard(callid)
+            if not calls:
+                del self.ucid_calls[ucid]
+                self.finished[ucid] = self.msgs
+    def complete(self, ucid):
+        '''
+        Completes 'ucid'.
+        :return: list of the (ucid, set of calling numbers) completed, empty
+                 if no calling number was seen with 'ucid'
+        '''
+        del self.finished[ucid]
+        callers = self.callers.pop(ucid)
+        if callers:
+            return [(ucid, callers)]
+        return []
+    def flush(self):
+        '''
+        Finishes all the open calls and completes their UCIDs, used at the
+        end of the input.
+        :return: list of (ucid, set of calling numbers) completed
+        '''
+        completed = []
+        while self.open_calls:
+            self.finish(iter(self.open_calls).next())
+        while self.finished:
+            completed.extend(self.complete(iter(self.finished).next()))
+        return completed
+
+def iterucids(mstfiles, grace=GRACE):
+    '''
+    Generates the (ucid, set of calling numbers) correlations from the MST
+    files as soon as the UCID is completed, see UCIDCorrelator.
+    :param grace: number of messages a UCID is kept for after its last call
+                  finished
+    '''
+    correlator = UCIDCorrelator(grace=grace)
+    for asai_domain_msg in asai_domain_mst_reader(mstfiles):
+        for item in correlator.update(ASAIDomainMsg(asai_domain_msg)):
+            yield item
+    for item in correlator.flush():
+        yield item
+
+def benchmark(mstfiles, fields=None):
+    '''
+    Prints the throughput of the DOMAIN message reader alone and of the
+    reader plus the decoding of every field through ASAIDomainMsg.
+    :param mstfiles: list of decoded MST files
+    :param fields: list of field names to access, by default all of them
+    :return: None
+    '''
+    fields = fields or LENGHTS.keys()
+    size = sum(os.path.getsize(x) for x in mstfiles if os.path.isfile(x))
+    mbytes = size / 1048576.0
+    start = time.time()
+    nmsgs = 0
+    for asai_domain_msg in asai_domain_mst_reader(mstfiles):
+        nmsgs += 1
+    read_time = max(time.time() - start, 1e-6)
+    start = time.time()
+    for asai_domain_msg in asai_domain_mst_reader(mstfiles):
+        msg = ASAIDomainMsg(asai_domain_msg)
+        for field in fields:
+            getattr(msg, field)
+    total_time = max(time.time() - start, 1e-6)
+    decode_time = max(total_time - read_time, 1e-6)
+    out = "%-7s %8d msgs %9.1f MB %8.2fs %10.0f msgs/s %8.1f MB/s"
+    print out % ("Read", nmsgs, mbytes, read_time, nmsgs / read_time,
+                 mbytes / read_time)
+    print out % ("Decode", nmsgs, mbytes, decode_time, nmsgs / decode_time,
+                 mbytes / decode_time)
+    print out % ("Total", nmsgs, mbytes, total_time, nmsgs / total_time,
+                 mbytes / total_time)
+
 def main():
     parser = OptionParser(usage='%prog [<options>] <decoded MST file(s)>',
             description="Serializes outbound ASAI DOMAIN messages from MST traces.")
@@ -481,14 +1000,37 @@ def main():
                     timestamp,link,callids,calling,called,connected,trunks,\
                     event                                    \
                     fields must be separated by |')
+    parser.add_option('-s', '--store',
+            action='store',
+            default=False,
+            dest='store',
+            metavar=' ',
+            help='call store file, built from the MST files if it does not \
+                  exist or they changed, filters are answered from its  \
+                  indexes. MST files can be omitted once it is built')
     parser.add_option('-e', '--expert',
             action='store_true',
             default=False,
             dest='expert',
             metavar=' ',
             help=SUPPRESS_HELP)
+    parser.add_option('-g', '--grace',
+            action='store',
+            type='int',
+            default=GRACE,
+            dest='grace',
+            metavar=' ',
+            help='number of messages a UCID is kept for after its last  \
+                  call ended, so that the calls reusing it are correlated \
+                  together, default %d' % GRACE)
+    parser.add_option('-b', '--benchmark',
+            action='store_true',
+            default=False,
+            dest='benchmark',
+            metavar=' ',
+            help=SUPPRESS_HELP)
     opts, args = parser.parse_args()
-    if not args:
+    if not args and not (opts.store and os.path.isfile(opts.store)):
         print "Need an MST input file (0 given), existing!"
         return 1
     else:
@@ -497,6 +1039,8 @@ def main():
         fields = [x for x in opts.fields.split("|") if x in LENGHTS]
     else:
         fields = DEFAULT_FIELDS
+    if opts.benchmark:
+        return benchmark(mstfiles, opts.fields and fields)
     if opts.filter_callid:
         filter_callid = set(opts.filter_callid.split("|"))
     else:
@@ -522,26 +1066,28 @@ def main():
         filter_link = set(opts.filter_link.split("|"))
     else:
         filter_link = None
+    if opts.store:
+        store = ASAICallStore.open(opts.store, mstfiles)
+        if store is None:
+            print "Cannot load call store %s, give the MST files to rebuild it!" % (
+                opts.store)
+            return 1
+    else:
+        store = None
     if not opts.expert:
-        reader = asai_domain_mst_reader(mstfiles)
+        if store is not None:
+            rows = store.query(callid=filter_callid, link=filter_link,
+                               number=filter_num, trunk=filter_trk,
+                               ucid=filter_ucid)
+            msgs = store.messages(rows)
+        else:
+            msgs = iterfiltered(mstfiles, filter_link, filter_callid,
+                                filter_num, filter_trk, filter_ucid)
         out = []
         for field in fields:
             out.append(field.title().rjust(LENGHTS[field]))
         print " ".join(out)
-        for asai_domain_msg in reader:
-            msg = ASAIDomainMsg(asai_domain_msg)
-            if filter_link and msg.link not in filter_link:
-                continue
-            if filter_callid and not filter_callid & set(msg.callids):
-                continue
-            elif filter_num and not filter_num & set([msg.calling,
-                                                      msg.called] +
-                                                   msg.connected):
-                continue
-            elif filter_trk and not filter_trk & set(msg.trunks):
-                continue
-            elif filter_ucid and msg.ucid not in filter_ucid:
-                continue
+        for msg in msgs:
             del out[:]
             for field in fields:
                 value = getattr(msg, field)
@@ -550,17 +1096,20 @@ def main():
                 out.append(value.rjust(LENGHTS[field]))
             print " ".join(out)
     else:
-        calls = get_calls(mstfiles)
-        ucids = {}
-        for call in calls.itervalues():
-            for ucid, calling, uui in izip(call.ucid, call.calling, call.uui):
-                if ucid and calling and len(calling) > 8:
-                    ucids.setdefault(ucid, set()).add(calling)
-        for key in sorted(ucids):
-            if len(ucids[key]) >= 2:
-                print "UCID: %s  Calling: %s" % (key.rjust(20), ' '.join(
-                        sorted(list(ucids[key]), key=len)))
-
+        if store is not None:
+            ucids = correlate_ucids(store.messages(row for callid in
+                                    store.callids() for row in
+                                    store.call_rows(callid)))
+            for key in sorted(ucids):
+                if len(ucids[key]) >= 2:
+                    print "UCID: %s  Calling: %s" % (key.rjust(20), ' '.join(
+                            sorted(list(ucids[key]), key=len)))
+        else:
+            for ucid, callers in iterucids(mstfiles, opts.grace):
+                if len(callers) >= 2:
+                    print "UCID: %s  Calling: %s" % (ucid.rjust(20), ' '.join(
+                            sorted(list(callers), key=len)))
+                    sys.stdout.flush()
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,81 @@
+'''
+Tests of the streaming UCID correlation of serial_asai.py, run with:
+python -m unittest test_serial_asai
+'''
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from serial_asai import UCIDCorrelator, correlate_ucids
+
+
+class Msg(object):
+    def __init__(self, callid, ucid, calling, event=""):
+        self.callids = [callid]
+        self.ucid = ucid
+        self.calling = calling
+        self.event = event
+
+
+def stream(msgs, max_idle, grace=100):
+    correlator = UCIDCorrelator(max_idle=max_idle, grace=grace)
+    completed = []
+    for msg in msgs:
+        completed.extend(correlator.update(msg))
+    completed.extend(correlator.flush())
+    return completed
+
+
+class TestUCIDCorrelator(unittest.TestCase):
+    def test_reused_ucid(self):
+        msgs = [Msg("0001", "U1", "111111111"),
+                Msg("0001", "U1", "111111111", "call ended"),
+                Msg("0002", "U1", "222222222")]
+        completed = stream(msgs, max_idle=100)
+        self.assertEqual(completed, [("U1", set(["111111111", "222222222"]))])
+        self.assertEqual(dict(completed), correlate_ucids(msgs))
+
+    def test_idle_ucid_is_released(self):
+        msgs = [Msg("0001", "U1", "111111111"),
+                Msg("0002", "U2", "222222222"),
+                Msg("0003", "U3", "333333333")]
+        correlator = UCIDCorrelator(max_idle=2, grace=0)
+        self.assertEqual(correlator.update(msgs[0]), [])
+        self.assertEqual(correlator.update(msgs[1]), [])
+        self.assertEqual(correlator.update(msgs[2]),
+                         [("U1", set(["111111111"]))])
+        self.assertEqual(sorted(correlator.flush()),
+                         [("U2", set(["222222222"])),
+                          ("U3", set(["333333333"]))])
+
+    def test_ended_ucid_is_released_after_grace(self):
+        msgs = [Msg("0001", "U1", "111111111"),
+                Msg("0001", "U1", "111111111", "call ended"),
+                Msg("0002", "U2", "222222222"),
+                Msg("0003", "U3", "333333333")]
+        correlator = UCIDCorrelator(max_idle=100, grace=2)
+        self.assertEqual(correlator.update(msgs[0]), [])
+        self.assertEqual(correlator.update(msgs[1]), [])
+        self.assertEqual(correlator.update(msgs[2]), [])
+        self.assertEqual(correlator.update(msgs[3]),
+                         [("U1", set(["111111111"]))])
+        self.assertFalse("U1" in correlator.callers)
+        self.assertEqual(len(correlator.open_calls), 2)
+
+    def test_reused_ucid_after_grace_is_separate(self):
+        msgs = [Msg("0001", "U1", "111111111", "call cleared"),
+                Msg("0002", "U2", "222222222"),
+                Msg("0003", "U1", "333333333")]
+        self.assertEqual(stream(msgs, max_idle=100, grace=1),
+                         [("U1", set(["111111111"])),
+                          ("U2", set(["222222222"])),
+                          ("U1", set(["333333333"]))])
+
+    def test_short_calling_is_ignored(self):
+        msgs = [Msg("0001", "U1", "1234"), Msg("", "U2", "222222222")]
+        self.assertEqual(stream(msgs, max_idle=100), [])
+        self.assertEqual(correlate_ucids(msgs), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
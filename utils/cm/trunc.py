@@ -3,47 +3,133 @@
 #       in the second argument, the optional third argument will specify the
 #       name of the output file, if not provided the input file name is
 #       appended with _trunc leaving the file extension intact.
+#       With the -s option the size is taken from the option and every
+#       argument is an input file, these are processed in parallel with -j.
 # Date: 2018-03-25
 # Author: szokoly@protonmail.com
 #############################################################################
 import os
 import sys
+from optparse import OptionParser
 from textwrap import wrap
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
 
-if len(sys.argv) < 3:
-    print('Usage: trunc <input .M file> <Call Record size> [<output .M file>]')
-    sys.exit(1)
-
-input = sys.argv[1]
-outlength = int(sys.argv[2])
-filename, file_ext = os.path.splitext(input)
-output = filename + '_trunc' + file_ext
-fdin = open(input)
-fdout = open(output, 'w')
-is_callrec = False
-buff = []
-
-for line in fdin:
-    if is_callrec == True:
-        if line.startswith('N'):
-            callrec = ''.join(buff)
-            callrec_len = len(callrec)
-            if outlength < callrec_len:
-                callrec = callrec[0:outlength * 2]
-            elif outlength > callrec_len:
-                callrec = callrec.ljust(outlength * 2, '0')
-            for chunk in wrap(callrec, 32):
-                l = ' '.join(wrap(chunk, 2))
-                fdout.write(''.join(('D', '\t\t', l, '\n')))
-            fdout.write(line)
-            is_callrec = False
-            buff[:] = []
-        buff.append(''.join(line.split()[1:]))
-    elif line.startswith('M') and line.split()[2] == '22':
-        fdout.write(line)
-        is_callrec = True
+BUFSIZE = 1024 * 1024
+DLINE = 'D\t\t' + ' '.join(['%s%s'] * 16) + '\n'
+
+
+def format_callrec(callrec):
+    '''
+    Returns the D lines of the callrec hex string, 16 bytes per line.
+    :param callrec: the Call Record as a string of hex digits
+    :return: string
+    '''
+    if '-' in callrec:
+        #textwrap breaks on hyphens, leave these to it
+        return ''.join(['D\t\t' + ' '.join(wrap(chunk, 2)) + '\n'
+                        for chunk in wrap(callrec, 32)])
+    full = len(callrec) - len(callrec) % 32
+    lines = DLINE * (full // 32) % tuple(callrec[:full])
+    tail = callrec[full:]
+    if tail:
+        pairs = [tail[i:i+2] for i in range(0, len(tail), 2)]
+        lines += 'D\t\t' + ' '.join(pairs) + '\n'
+    return lines
+
+
+def trunc(fdin, fdout, outlength):
+    '''
+    Copies fdin to fdout with the Call Records resized to outlength bytes.
+    :param fdin: input file object
+    :param fdout: output file object
+    :param outlength: Call Record size in bytes
+    :return: None
+    '''
+    is_callrec = False
+    buff = []
+    write = fdout.write
+    for line in fdin:
+        if is_callrec:
+            if line.startswith('N'):
+                callrec = ''.join(buff)
+                callrec_len = len(callrec)
+                if outlength < callrec_len:
+                    callrec = callrec[0:outlength * 2]
+                elif outlength > callrec_len:
+                    callrec = callrec.ljust(outlength * 2, '0')
+                write(format_callrec(callrec))
+                write(line)
+                is_callrec = False
+                buff[:] = []
+            buff.append(''.join(line.split()[1:]))
+        elif line.startswith('M') and line.split()[2] == '22':
+            write(line)
+            is_callrec = True
+        else:
+            write(line)
+
+
+def trunc_file(task):
+    input, output, outlength = task
+    fdin = open(input, 'r', BUFSIZE)
+    try:
+        fdout = open(output, 'w', BUFSIZE)
+        try:
+            trunc(fdin, fdout, outlength)
+        finally:
+            fdout.close()
+    finally:
+        fdin.close()
+    return output
+
+
+def trunc_name(input):
+    filename, file_ext = os.path.splitext(input)
+    return filename + '_trunc' + file_ext
+
+
+def main():
+    parser = OptionParser(usage='\n'.join((
+        '%prog <input .M file> <Call Record size> [<output .M file>]',
+        '       %prog -s <Call Record size> [-j <jobs>] <input .M file>'
+        ' [<input .M file>...]')))
+    parser.add_option('-s', '--size',
+        action='store',
+        default=None,
+        dest='size',
+        type='int',
+        help='Call Record size, all arguments are input .M files')
+    parser.add_option('-j', '--jobs',
+        action='store',
+        default=1,
+        dest='jobs',
+        type='int',
+        help='number of input files processed in parallel, the default is 1')
+    opts, args = parser.parse_args()
+    if opts.size is not None and args:
+        tasks = [(x, trunc_name(x), opts.size) for x in args]
+    elif opts.size is None and len(args) in (2, 3):
+        if len(args) == 3:
+            output = args[2]
+        else:
+            output = trunc_name(args[0])
+        tasks = [(args[0], output, int(args[1]))]
+    else:
+        print('Usage: trunc <input .M file> <Call Record size> [<output .M file>]')
+        return 1
+    if opts.jobs > 1 and len(tasks) > 1 and multiprocessing is not None:
+        pool = multiprocessing.Pool(min(opts.jobs, len(tasks)))
+        try:
+            pool.map(trunc_file, tasks)
+            pool.close()
+        finally:
+            pool.terminate()
     else:
-        fdout.write(line)
+        for task in tasks:
+            trunc_file(task)
 
-fdin.close()
-fdout.close()
+if __name__ == '__main__':
+    sys.exit(main())